@@ -2,6 +2,7 @@ import os
 import sys
 import subprocess
 from shutil import copy, rmtree
+from concurrent.futures import ThreadPoolExecutor
 
 sys.path.append(".")
 from conversions import *
@@ -40,25 +41,23 @@ def clean():
     print("🧹 Cleaning is done")
 
 
-def main():
-    # AI model stuff
-    # For now
-    if sys.platform == "win32":
-        dump_onnx_model("Qwen/Qwen3-0.6B", "build")
-
-    # create dewey.json
-    for system in defined_classifications:
-        create_classification_system(
-            dest_dir="data",
-            data_dir=f"build/classification_systems/{system}",
-            type=system,
-        )
-    create_legal(
-        legal_path="build/legal/CREDITS.txt", notice_path="build/legal/NOTICE.txt"
+def run(args: list, quiet: bool = False) -> int:
+    """Runs a command with its output piped back in large buffered chunks instead of straight to the console."""
+    process = subprocess.Popen(
+        args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        bufsize=1 << 16,
+        text=True,
     )
-    copy("LICENSE.txt", "build/legal/LICENSE.txt")
+    for line in process.stdout:
+        if not quiet:
+            sys.stdout.write(line)
+    return process.wait()
 
-    # create metadata for the exe file (on Windows)
+
+def main(quiet: bool = False):
+    # create metadata for the exe file (on Windows) while the other steps run
     args = [
         "pyivf-make_version",
         "--source-format",
@@ -68,8 +67,41 @@ def main():
         "--outfile",
         "build/file_version_info.txt",
     ]
-    subprocess.run(args)
-    print("🛠️  EXE metadata created")
+    make_version = subprocess.Popen(args)
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        # AI model stuff
+        # For now
+        onnx_dump = (
+            executor.submit(dump_onnx_model, "Qwen/Qwen3-0.6B", "build")
+            if sys.platform == "win32"
+            else None
+        )
+
+        # create dewey.json
+        for system in defined_classifications:
+            create_classification_system(
+                dest_dir="data",
+                data_dir=f"build/classification_systems/{system}",
+                type=system,
+            )
+        create_legal(
+            legal_path="build/legal/CREDITS.txt", notice_path="build/legal/NOTICE.txt"
+        )
+        copy("LICENSE.txt", "build/legal/LICENSE.txt")
+
+        # PyInstaller needs the version file and the models
+        if make_version.wait() != 0:
+            raise RuntimeError("pyivf-make_version failed to create the EXE metadata")
+        print("🛠️  EXE metadata created")
+        if onnx_dump is not None:
+            onnx_dump.result()  # re-raises if the dump failed
+    finally:
+        if make_version.poll() is None:
+            make_version.kill()
+            make_version.wait()
+        executor.shutdown(wait=False)
 
     windows_stuff = (
         [
@@ -98,7 +130,8 @@ def main():
         "build/executables",
         "app.py",
     ] + windows_stuff
-    subprocess.run(args)
+    if run(args, quiet=quiet) != 0:
+        raise RuntimeError("PyInstaller failed to freeze the app")
     print("🛠️  PyInstaller done")
 
     if sys.platform == "win32":
@@ -106,7 +139,7 @@ def main():
         issc_path = os.path.join(
             os.environ["PROGRAMFILES(x86)"], "Inno Setup 6/ISCC.exe"
         )
-        subprocess.run([issc_path, "build/create_installer.iss"])
+        subprocess.run([issc_path, "build/create_installer.iss"], check=True)
     elif sys.platform == "darwin":
         raise NotImplementedError("building a PKG for MacOS is currently unsupported")
 
@@ -118,7 +151,7 @@ def main():
 
         commands = [remove_pkgroot, make_pkgroot, make_bin, rsync]
         for command in commands:
-            subprocess.run(command)
+            subprocess.run(command, check=True)
         bin_params = dedent(
             """\
         #!/bin/bash
@@ -129,7 +162,7 @@ def main():
         Path("build/pkgroot/usr/local/bin/librarian").write_text(
             bin_params, encoding="utf-8"
         )
-        subprocess.run(["chmod", "755", "build/pkgroot/usr/local/bin/librarian"])
+        subprocess.run(["chmod", "755", "build/pkgroot/usr/local/bin/librarian"], check=True)
 
         # Let's build the installer package
         Path("build/installer").mkdir(exist_ok=True)
@@ -152,14 +185,14 @@ def main():
             "build/installer/librarian-unsigned.pkg",
         ]
         for command in (pkgbuild, productbuild):
-            subprocess.run(command)
+            subprocess.run(command, check=True)
 
         # Creates the uninstaller package
         rm_dir = ["rm", "-rf", "build/UninstallScripts"]
         make_dirs = ["mkdir", "-p", "build/UninstallScripts"]
 
         for command in (rm_dir, make_dirs):
-            subprocess.run(command)
+            subprocess.run(command, check=True)
 
         Path("build/UninstallScripts/postinstall").write_text(
             dedent(
@@ -198,7 +231,7 @@ def main():
             ),
             encoding="utf-8",
         )
-        subprocess.run(["chmod", "755", "build/UninstallScripts/postinstall"])
+        subprocess.run(["chmod", "755", "build/UninstallScripts/postinstall"], check=True)
 
         pkgbuild = [
             "pkgbuild",
@@ -211,7 +244,7 @@ def main():
             version,
             "build/installer/Uninstall-Librarian.pkg",
         ]
-        subprocess.run(pkgbuild)
+        subprocess.run(pkgbuild, check=True)
     else:
         raise NotImplementedError("this stage of build not supported on your OS")
 
@@ -223,4 +256,4 @@ if __name__ == "__main__":
     if len(args) > 0 and args[0] == "clean":
         clean()
     else:
-        main()
+        main(quiet="--quiet" in args)
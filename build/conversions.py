@@ -1,5 +1,6 @@
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import asdict
 from pathlib import Path
 from uuid import uuid4, uuid7
@@ -17,6 +18,11 @@ from librarian import Librarian
 from bookshelf_manager.catalog_manager import Metadata
 
 
+def dumps_json(obj) -> bytes:
+    # orjson can only indent by 2, and the shipped data files are indented by 4
+    return json.dumps(obj, indent=4, ensure_ascii=False).encode("utf-8")
+
+
 # model conversion time
 def dump_onnx_model(huggingface_model: str, working_dir: str):
     comps = huggingface_model.split("/")
@@ -43,7 +49,7 @@ def dump_onnx_model(huggingface_model: str, working_dir: str):
         "--output_path",
         output_dir,
     ]
-    subprocess.run(args)
+    subprocess.run(args, check=True)
 
     src_path = output_dir / "model"
     os.rename(src_path, model_dir)
@@ -77,24 +83,26 @@ def dump_foundry_local(out_dir: str):
             "--download-directory",
             path,
         ]
-        subprocess.run(args)
+        subprocess.run(args, check=True)
 
 
 # other stuff
 def dump_class_results(path: str, type: str, data: list[Category]):
     system = ClassificationSystem(type)
     system.data_list = data
-    contents = json.dumps(system.dumps(), indent=4, ensure_ascii=False)
-    Path(f"{path}/{type}.json").write_text(contents, encoding="utf-8")
+    Path(f"{path}/{type}.json").write_bytes(dumps_json(system.dumps()))
 
 
-def __process_dewey(lines: list[str], step=100):
+def __process_dewey(lines: list[str], step=100, start=0, end=None):
+    # Works on index ranges of lines instead of slicing out a copy per level
+    if end is None:
+        end = len(lines)
     infos = []
-    for i in range(0, len(lines), step):
+    for i in range(start, end, step):
         code, name = lines[i].split(maxsplit=1)
         if step != 1:
             info = Category(
-                code, name, __process_dewey(lines[i : i + step], step // 10)
+                code, name, __process_dewey(lines, step // 10, i, min(i + step, end))
             )
         else:
             info = Category(code, name)
@@ -209,68 +217,79 @@ def convert_old_librarian_v10(librarian_path):
 def convert_old_catalog_v10(catalog_path):
     contents: str = Path(catalog_path).read_text(encoding="utf-8")
     old_catalog: dict = json.loads(contents)
-    new_catalog: list[dict] = []
-    for metadata in old_catalog.values():
-        new_catalog.append(
-            asdict(
-                Book(
-                    id=str(uuid4()),
-                    filename=metadata["FileName"],
-                    isbn=metadata["ISBN"],
-                    call_number=metadata["DeweyNumber"],
-                    title=metadata["Title"],
-                    authors=[
-                        author.title().strip()
-                        for author in metadata["Author"].split(",")
-                    ],
-                    publisher=metadata["Publisher"],
-                    series=metadata["Series"],
-                    edition=metadata["Edition"],
-                    volume=metadata["Volume"],
-                    year=int(metadata["Year"]),
-                    url=metadata["URL"],
-                    description=metadata["Description"],
-                    notes="",
-                )
-            )
-        )
-    contents: str = json.dumps(new_catalog, indent=4, ensure_ascii=False)
-    Path(catalog_path).write_text(contents, encoding="utf-8")
+    new_catalog: list[dict] = [
+        {
+            "id": str(uuid4()),
+            "filename": metadata["FileName"],
+            "isbn": metadata["ISBN"],
+            "call_number": metadata["DeweyNumber"],
+            "title": metadata["Title"],
+            "authors": [
+                author.title().strip() for author in metadata["Author"].split(",")
+            ],
+            "publisher": metadata["Publisher"],
+            "series": metadata["Series"],
+            "edition": metadata["Edition"],
+            "volume": metadata["Volume"],
+            "year": int(metadata["Year"]),
+            "url": metadata["URL"],
+            "description": metadata["Description"],
+            "notes": "",
+        }
+        for metadata in old_catalog.values()
+    ]
+    Path(catalog_path).write_bytes(dumps_json(new_catalog))
     print("⚒️  Sucessfully converted catalog v1.0")
 
 
+def walk_files(root: str):
+    """Yields the DirEntry of every file below root using a single directory traversal."""
+    stack = [root]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file():
+                    yield entry
+
+
 def create_legal(
     legal_path: str,
     notice_path: str,
     search_paths: list[str] = [".venv"],
 ):
-    legal, notice = "", ""
-
-    patterns = [
-        "license*",
-        "copying*",
-        "notice*",
+    legal_parts, notice_parts = [], []
+
+    prefixes = (
+        "license",
+        "copying",
+        "notice",
+    )
+    paths = [
+        Path(entry.path)
+        for search_path in search_paths
+        for entry in walk_files(search_path)
+        if entry.name.lower().startswith(prefixes)
     ]
-    for search_path in search_paths:
-        search_path = Path(search_path)
-        paths = []
-        for pattern in patterns:
-            paths.extend(search_path.rglob(pattern, case_sensitive=False))
-
-        for path in paths:
-            if not path.is_file():
-                continue
-            contents = path.read_text(encoding="utf-8")
-            filler = f"\n\n{"-" * 80}\n\n"
-            if path.name.startswith("NOTICE"):
-                notice += contents + filler
-            else:
-                legal += contents + filler
+
+    read_file = lambda path: (path.name, path.read_text(encoding="utf-8", errors="replace"))
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        results = list(executor.map(read_file, paths))
+
+    filler = f"\n\n{"-" * 80}\n\n"
+    for name, contents in results:
+        parts = notice_parts if name.startswith("NOTICE") else legal_parts
+        parts.extend((contents, filler))
 
     # Write to files
     infos = {
-        legal_path: legal,
-        notice_path: notice,
+        legal_path: "".join(legal_parts),
+        notice_path: "".join(notice_parts),
     }
     for path, contents in infos.items():
         os.makedirs(os.path.dirname(path), exist_ok=True)
@@ -7,10 +7,10 @@ import toml
 requirements = Path("requirements.txt").read_text(encoding="utf-8")
 
 
-core_dependencies = [
+core_dependencies = {
     "openai",
     "Send2Trash",
-    "dacite",
+    "orjson",
     "Markdown",
     "prompt_toolkit",
     "PyMuPDF",
@@ -28,13 +28,15 @@ core_dependencies = [
     "foundry-local-sdk",
     "sentence-transformers",
     "pix2text",
-]
+}
 os_specific = {
     "windows": ["pywin32"]
 }
 dependencies = []
 
 for line in requirements.splitlines():
+    if "==" not in line:
+        continue  # comments, blank lines, etc.
     name, version = line.split("==")
 
     if name in core_dependencies:
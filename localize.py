@@ -2,14 +2,30 @@
 Translate the README.md into other languages (i.e. Mandarin).
 """
 
-from openai import Client
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+from openai import Client
+
 # TODO: Need to localize the entire package for all the "Natural Language" listed languages under pypi.org filter
 languages = {"cn": "simplified chinese"}
 
 # Use a very strong model for the best results
 client = Client(base_url="", api_key="")
-for abbreviation, language in languages:
+
+
+def translate(abbreviation: str, language: str):
     response = client.responses.create(instructions="", input="")
-    Path(f"README-{abbreviation.upper()}.md").write_text(response.output_text)
+    Path(f"README-{abbreviation.upper()}.md").write_text(
+        response.output_text, encoding="utf-8"
+    )
+
+
+# Translations are independent requests, so run them concurrently
+with ThreadPoolExecutor() as executor:
+    futures = [
+        executor.submit(translate, abbreviation, language)
+        for abbreviation, language in languages.items()
+    ]
+    for future in futures:
+        future.result()
@@ -1,16 +1,19 @@
 import sys
 import os
+from functools import cache
 from pathlib import Path
 
 from .utils import get_resource_path
 
 
-def get_app_path(self):
+@cache
+def get_app_path() -> Path:
     return Path(get_resource_path("")).parent
 
 
-def get_env_paths(contents: str):
-    return [path.lower() for path in contents.split(";")]
+def path_contains(contents: str, target: str) -> bool:
+    """Checks whether the PATH-style string contains target, ignoring case like Windows does."""
+    return target.lower() in {path.lower() for path in contents.split(";")}
 
 
 def install(user=False):
@@ -18,11 +21,8 @@ def install(user=False):
         from py_setenv import setenv
 
         contents = setenv("Path", user=user)
-        lower_paths = get_env_paths(contents)
-
         original_path = str(get_app_path())
-        lower_path = original_path.lower()
-        if lower_path not in lower_paths:
+        if not path_contains(contents, original_path):
             setenv("Path", original_path, append=True, user=user)
     else:
         raise NotImplementedError(
@@ -34,15 +34,16 @@ def uninstall():
     if sys.platform == "win32":
         from py_setenv import setenv
         
+        lower_path = str(get_app_path()).lower()
         privileges = [False, True]
         for user in privileges:
             contents = setenv("Path", user=user)
             original_paths = contents.split(";")
-            lower_paths = get_env_paths(contents)
+            indices = {path.lower(): i for i, path in enumerate(original_paths)}
 
-            lower_path = str(get_app_path()).lower()
-            if lower_path in lower_paths:
-                original_paths.pop(lower_paths.index(lower_path))
+            index = indices.get(lower_path)
+            if index is not None:
+                del original_paths[index]
                 setenv("Path", ";".join(original_paths), user=user)
     else:
         raise NotImplementedError(
@@ -1,40 +1,25 @@
 """Defines a class called Book and a CatalogManager to keep track of books and where they are located."""
 
 import json
-from dataclasses import asdict, dataclass
+import os
+from collections import Counter
+from dataclasses import dataclass, fields
 from pathlib import Path
 
-from dacite import from_dict
+import orjson
 from send2trash import send2trash
 
+BLANK_ISBN = "0" * 13  # stored for books whose ISBN is unknown
 
-@dataclass
-class Metadata:
-    """For defining metadata for different mediums such as music, audio recordings, movies, etc."""
-    id: str
-    hash: str
-    filename: str
-    call_number: str
-    type: str
-    data: Book | None
-
-    def __lt__(self, other: "Metadata"):
-        return self.filename.casefold() < other.filename.casefold()
 
-    def __str__(self):
-        result = ""
-        for key, val in asdict(self).items():
-            key = key.replace("_", " ").title()
-            if isinstance(val, Book):
-                result += '\n' + str(val)
-            elif isinstance(val, list):
-                result += f"{key}: {str(val)[1:-1].replace("'", "")}\n"
-            else:
-                result += f"{key}: {val}\n"
-        return result
+def _atomic_write_bytes(path: Path, data: bytes):
+    """Writes data next to path and renames it into place, so a crash never leaves a truncated file."""
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
 
 
-@dataclass
+@dataclass(slots=True)
 class Book:
     """Book version 1.1"""
     isbn: str
@@ -53,14 +38,68 @@ class Book:
         return self.authors[0].casefold() < other.authors[0].casefold()
 
     def __str__(self):
-        result = ""
-        for key, val in asdict(self).items():
-            key = key.replace("_", " ").title()
+        parts = []
+        for name, label in _BOOK_LABELS:
+            val = getattr(self, name)
             if isinstance(val, list):
-                result += f"{key}: {str(val)[1:-1].replace("'", "")}\n"
+                parts.append(f"{label}: {", ".join(val)}")
             else:
-                result += f"{key}: {val}\n"
-        return result
+                parts.append(f"{label}: {val}")
+        return "\n".join(parts) + "\n"
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name, _ in _BOOK_LABELS}
+
+
+_BOOK_LABELS = [(field.name, field.name.replace("_", " ").title()) for field in fields(Book)]
+_BOOK_FIELDS = frozenset(name for name, _ in _BOOK_LABELS)
+
+
+@dataclass(slots=True)
+class Metadata:
+    """For defining metadata for different mediums such as music, audio recordings, movies, etc."""
+    id: str
+    hash: str
+    filename: str
+    call_number: str
+    type: str
+    data: Book | None
+
+    @classmethod
+    def from_dict(cls, values: dict) -> "Metadata":
+        # Ignore keys written by newer versions instead of failing the whole catalog
+        values = {key: val for key, val in values.items() if key in _METADATA_FIELDS}
+        data = values["data"]
+        if data is not None:
+            data = Book(**{key: val for key, val in data.items() if key in _BOOK_FIELDS})
+        return cls(**{**values, "data": data})
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "hash": self.hash,
+            "filename": self.filename,
+            "call_number": self.call_number,
+            "type": self.type,
+            "data": self.data.to_dict() if self.data is not None else None,
+        }
+
+    def __lt__(self, other: "Metadata"):
+        return self.filename.casefold() < other.filename.casefold()
+
+    def __str__(self):
+        parts = []
+        for name, label in _METADATA_LABELS:
+            val = getattr(self, name)
+            if isinstance(val, Book):
+                parts.append("\n" + str(val))
+            else:
+                parts.append(f"{label}: {val}\n")
+        return "".join(parts)
+
+
+_METADATA_LABELS = [(field.name, field.name.replace("_", " ").title()) for field in fields(Metadata)]
+_METADATA_FIELDS = frozenset(name for name, _ in _METADATA_LABELS)
 
 
 class CoverImageManager:
@@ -74,8 +113,7 @@ class CoverImageManager:
         return (self.dir / id).with_suffix(".jpg")
 
     def add(self, id: str, cover_image: bytes):
-        path = self.get_path(id)
-        path.write_bytes(cover_image)
+        _atomic_write_bytes(self.get_path(id), cover_image)
 
     def remove(self, id: str):
         path = self.get_path(id)
@@ -94,24 +132,54 @@ class CatalogManager:
         self.catalog_dir = home_dir / "catalog"
         self.catalog_dir.mkdir(exist_ok=True)
         self.cover_image_manager = CoverImageManager(home_dir / "cover_images")
+        self.reload()
+
+    def reload(self):
+        """Reads every catalog entry from disk into the in-memory index keyed by id."""
+        self.entries: dict[str, Metadata] = {
+            path.name[:-5]: self.load(path) for path in self.glob_over_dir()
+        }
+        # ISBN indexed for each id, plus how many entries share each ISBN
+        self.isbn_by_id: dict[str, str] = {}
+        self.isbn_counts: Counter[str] = Counter()
+        for metadata in self.entries.values():
+            self.index_isbn(metadata)
+
+    def index_isbn(self, metadata: Metadata):
+        book = metadata.data
+        if metadata.type == "book" and book and book.isbn != BLANK_ISBN:
+            self.isbn_by_id[metadata.id] = book.isbn
+            self.isbn_counts[book.isbn] += 1
+
+    def unindex_isbn(self, id: str):
+        isbn = self.isbn_by_id.pop(id, None)
+        if isbn is not None:
+            self.isbn_counts[isbn] -= 1
+            if self.isbn_counts[isbn] <= 0:
+                del self.isbn_counts[isbn]
+
+    def load(self, path: Path) -> Metadata:
+        return Metadata.from_dict(orjson.loads(path.read_bytes()))
 
     def save(self, metadata: Metadata):
-        contents = json.dumps(asdict(metadata), ensure_ascii=False)
         path = self.catalog_dir / f"{metadata.id}.json"
-        path.write_text(contents, encoding="utf-8")
+        # json keeps the ", "/": " separators of existing entries, so saves don't reformat
+        # files in the version history; orjson is only used on the hot loading path
+        contents = json.dumps(metadata.to_dict(), ensure_ascii=False)
+        _atomic_write_bytes(path, contents.encode("utf-8"))
+        self.entries[metadata.id] = metadata
+        self.unindex_isbn(metadata.id)
+        self.index_isbn(metadata)
 
     def exists(self, id: str):
         if len(id) == 13:
             # is isbn
-            id = [
-                meta for meta, cover_path in self if meta.type == "book" and meta.data and meta.data.isbn == id
-            ][0]
-        path = self.catalog_dir / f"{id}.json"
-        return path.exists()
+            return id in self.isbn_counts
+        return id in self.entries
 
     def add(self, metadata: Metadata, cover_image: str):
         """Adds the given metadata to the library catalog."""
-        if self.__contains__(metadata.id):
+        if metadata.id in self.entries:
             raise ValueError(f"metadata {metadata.id} already exists")
         self.save(metadata)
         if cover_image:
@@ -119,10 +187,10 @@ class CatalogManager:
 
     def remove(self, id: str):
         """Removes metadata associated with the given id from the library catalog."""
-        if not self.__contains__(id):
+        if self.entries.pop(id, None) is None:
             raise KeyError(f"the metadata with id {id} does not exist")
-        path = self.catalog_dir / f"{id}.json"
-        send2trash(path)
+        self.unindex_isbn(id)
+        send2trash(self.catalog_dir / f"{id}.json")
         self.cover_image_manager.remove(id)
 
     def edit(self, metadata: Metadata, cover_image: bytes):
@@ -131,35 +199,24 @@ class CatalogManager:
         self.cover_image_manager.add(metadata.id, cover_image)
 
     def get(self, id: str) -> tuple:
-        path = self.catalog_dir / f"{id}.json"
         try:
-            contents = path.read_text(encoding="utf-8")
-        except FileNotFoundError:
+            metadata = self.entries[id]
+        except KeyError:
             raise LookupError(f"book {id} doesn't exist")
 
-        metadata = from_dict(Metadata, json.loads(contents))
         cover_image = self.cover_image_manager.get(id)
         return (metadata, cover_image)
-    
 
     def glob_over_dir(self) -> list[Path]:
         return list(self.catalog_dir.glob("*.json"))
 
     def get_num_books(self) -> int:
-        files = self.glob_over_dir()
-        return len(files)
-    
+        return len(self.entries)
+
     def __iter__(self):
-        self.iter_paths = self.glob_over_dir()
-        return self
-    
-    def __next__(self):
-        if self.iter_paths:
-            id = self.iter_paths[0].name[:-5]
-            del self.iter_paths[0]
-            return self.get(id)
-        else:
-            raise StopIteration
+        # Snapshot the ids so the catalog can be modified while iterating
+        for id, metadata in list(self.entries.items()):
+            yield (metadata, self.cover_image_manager.get(id))
 
     def __len__(self):
         return self.get_num_books()
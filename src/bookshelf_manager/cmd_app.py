@@ -1,38 +1,75 @@
-import json
 import os
 import random
 import re
 import subprocess
 import sys
+import time
 import webbrowser
 from atexit import register
 from copy import deepcopy
-from dataclasses import asdict, dataclass
+from dataclasses import asdict, dataclass, fields
 from datetime import datetime
+from functools import cached_property, lru_cache
 from hashlib import md5
 from pathlib import Path
 from shutil import copy, get_terminal_size
-from textwrap import dedent, fill
+from textwrap import TextWrapper, dedent
 from typing import Literal
 from uuid import uuid7
 
-from dacite import from_dict
 from llama_index.llms.openai_like import OpenAILike
 from markdown import markdown
+from openai import OpenAI
+import orjson
 from platformdirs import user_config_dir
 from prompt_toolkit import HTML, prompt
+from prompt_toolkit.shortcuts import clear as clear_screen
 from prompt_toolkit.shortcuts import print_formatted_text as print
 
-from .catalog_manager import Book, Metadata
+from .catalog_manager import BLANK_ISBN, Book, Metadata
 from .librarian import Config, Librarian
 from .search_manager import SearchResult
-from .teacher import Teacher
 from .utils import defined_classifications, get_resource_path
 
 if sys.platform == "win32":
     import win32api
     import win32con
 
+_SLUG_RE = re.compile(r"[^\w-]+")
+_ISBN_RE = re.compile(r"[^0-9X]")
+_THINK_RE = re.compile(r"<think>.*?</think>", re.DOTALL)
+_THINK_TAG_RE = re.compile(r"<(/?think)>")
+
+_CLASSIFICATION_CHOICES = {
+    "Dewey Decimal Classification (DDC)": "dewey",
+    "Library of Congress Classification (LCC)": "lcc",
+    "Universal Decimal Classification (UDC)": "udc",
+}
+_CLASSIFICATION_MENU = (
+    "Pick a library classification system:\n"
+    + "".join(
+        f"{num}. {choice}\n"
+        for num, choice in enumerate(_CLASSIFICATION_CHOICES, start=1)
+    )
+    + "> "
+)
+# Accepts either the menu number or the name of the system
+_CLASSIFICATION_ANSWERS = {
+    str(num): system
+    for num, system in enumerate(_CLASSIFICATION_CHOICES.values(), start=1)
+} | {system: system for system in defined_classifications}
+
+_MODELS_TTL = 5 * 60  # seconds
+
+
+def error_msg(msg: str) -> HTML:
+    return HTML(f"<ansired>{msg}</ansired>")
+
+
+def _maybe_clean(new: str, old: str) -> str:
+    """Normalizes a prompt answer unless it is the (already normalized) default."""
+    return new if new == old else new.strip().title()
+
 
 @dataclass
 class AppConfig:
@@ -51,9 +88,16 @@ class CmdApp:
             )
         )
         self.config_file = config_dir / "config.json"
+        self.librarian_path = Path.cwd() / ".librarian"
+        self.models_cache: tuple[float, list[str]] | None = None
         if self.config_file.exists():
-            contents = self.config_file.read_text(encoding="utf-8")
-            self.app_config = from_dict(AppConfig, json.loads(contents))
+            values = orjson.loads(self.config_file.read_bytes())
+            # Ignore keys written by other versions instead of failing at startup
+            names = {field.name for field in fields(AppConfig)}
+            self.app_config = AppConfig(
+                **{key: val for key, val in values.items() if key in names}
+            )
+            self.saved_app_config = asdict(self.app_config)
         else:
             print("LLM Acesss Config (config is stored inside the appdata folder):")
             base_url = prompt("Base URL: ", default="http://localhost:1234/v1")
@@ -74,65 +118,53 @@ class CmdApp:
         )
 
     def save_config(self):
-        contents = json.dumps(asdict(self.app_config))
-        self.config_file.write_text(contents, encoding="utf-8")
+        values = asdict(self.app_config)
+        self.config_file.write_bytes(orjson.dumps(values))
+        self.saved_app_config = values
 
     def close(self):
-        self.save_config()
+        # Only rewrite the config file when a setting actually changed
+        if asdict(self.app_config) != self.saved_app_config:
+            self.save_config()
         if hasattr(self, "librarian"):
             self.librarian.close()
+        # The one client and its keep-alive connections are shared by every model request
+        if "openai_client" in self.__dict__:
+            self.openai_client.close()
 
-    def create_librarian_dir(self, library_path: Path):
-        library_path.mkdir()
-        if sys.platform == "win32":
-            win32api.SetFileAttributes(
-                str(library_path), win32con.FILE_ATTRIBUTE_HIDDEN
-            )
+    def create_librarian_dir(self, library_path: Path) -> bool:
+        """Creates the librarian directory and returns whether it did not exist before."""
+        try:
+            library_path.mkdir()
+            if sys.platform == "win32":
+                win32api.SetFileAttributes(
+                    str(library_path), win32con.FILE_ATTRIBUTE_HIDDEN
+                )
+        except FileExistsError:
+            return False
+        return True
 
     def do_chore(self):
         # Chores
         default_config = Config()
-        librarian_path = Path(".librarian")
-        if not librarian_path.exists():
+        librarian_path = self.librarian_path
+        if self.create_librarian_dir(librarian_path):
             print(
                 "Welcome to Librarian, a simple program that helps you make sense of documents."
             )
-            self.create_librarian_dir(librarian_path)
             while True:
-                try:
-                    choices = {
-                        "Dewey Decimal Classification (DDC)": "dewey",
-                        "Library of Congress (LOC)": "loc",
-                        "Universal Decimal Classification (UDC)": "udc",
-                    }
-                    formatted_choices = "\n".join(
-                        f"{num}. {choice}"
-                        for num, choice in enumerate(choices, start=1)
-                    )
-                    answer = (
-                        prompt(
-                            f"Pick a library classification system:\n{formatted_choices}\n> ",
-                            default="1",
-                        )
-                        .strip()
-                        .lower()
-                    )
-                    index = int(answer) - 1
-                    if index >= len(choices):
-                        raise ValueError("invalid choice")
-                    default_config.classification_system = choices[list(choices)[index]]
+                answer = prompt(_CLASSIFICATION_MENU, default="1").strip().lower()
+                if answer in _CLASSIFICATION_ANSWERS:
+                    default_config.classification_system = _CLASSIFICATION_ANSWERS[answer]
                     break
-                except Exception as err:
-                    print(HTML(f"<ansired>{err}</ansired>"))
+                print(error_msg(f"invalid choice {answer}"))
 
-            copy(
-                get_resource_path(
-                    Path(f"data/{default_config.classification_system}.json")
-                ),
-                librarian_path,
-            )
+            filename = f"{default_config.classification_system}.json"
+            copy(get_resource_path(Path("data") / filename), librarian_path / filename)
 
         # Initializing librarian
+        if hasattr(self, "librarian"):
+            self.librarian.close()  # being replaced, e.g. after a sync
         self.librarian = Librarian(
             librarian_path=librarian_path,
             default_config=default_config,
@@ -157,6 +189,10 @@ class CmdApp:
         metadata = self.get_metadata_info(filepath=path)
         self.librarian.add(path, metadata)
 
+    def clear(self):
+        # prompt_toolkit's output clears legacy Windows consoles as well as VT terminals
+        clear_screen()
+
     def edit(self, comps: list[str], search_results: list[SearchResult] | None = None):
         id = comps[1]
         if id.isnumeric():
@@ -164,19 +200,34 @@ class CmdApp:
         book = self.librarian[id][0]
         self.librarian.edit(book)
 
-    def exam(self, comps: list[str]):
-        models_info = self.client.models.list().model_dump()
-        models = [
-            item["id"] for item in models_info["data"] if not "embed" in item["id"]
-        ]
+    @cached_property
+    def openai_client(self) -> OpenAI:
+        return OpenAI(base_url=self.app_config.base_url, api_key=self.app_config.api_key)
+
+    def get_models(self) -> list[str]:
+        """Returns the ids of the non-embedding models served by the API, cached for a few minutes."""
+        now = time.monotonic()
+        if self.models_cache is None or now - self.models_cache[0] > _MODELS_TTL:
+            models = [
+                model.id
+                for model in self.openai_client.models.list().data
+                if "embed" not in model.id
+            ]
+            self.models_cache = (now, models)
+        return self.models_cache[1]
+
+    def exam(self):
+        models = self.get_models()
 
         choices = "\n".join([f"{i+1}. {name}" for i, name in enumerate(models)])
         user_input = prompt(f"Pick one of the following models:\n{choices}\n> ")
         model_name = models[int(user_input) - 1]
 
+        from .teacher import Teacher  # pulls in pypandoc, pikepdf and yaml
+
         teacher = Teacher(
             librarian=self.librarian,
-            chat_client=self.client,
+            chat_client=self.openai_client,
             model_name=model_name,
         )
 
@@ -252,17 +303,9 @@ class CmdApp:
     def chat(self, comps: list[str]):
         markdown_output = self.librarian.question(" ".join(word for word in comps[1:]))
         if self.librarian.config.exclude_thinking_tag:
-            markdown_output = re.sub(
-                r"<think>.*</think>",
-                "",
-                markdown_output,
-                flags=re.DOTALL,
-            )
-        markdown_output = markdown_output.replace("<think>", "&lt;think&gt;").replace(
-            "</think>", "&lt;/think&gt;"
-        )
-        html_output = HTML(markdown(markdown_output))
-        print(html_output)
+            markdown_output = _THINK_RE.sub("", markdown_output)
+        markdown_output = _THINK_TAG_RE.sub(r"&lt;\1&gt;", markdown_output)
+        print(HTML(markdown(markdown_output)))
     
     def random(self):
         items = list(self.librarian.catalog_manager)
@@ -322,102 +365,127 @@ class CmdApp:
 
     def start(self):
         do_once = True
-        if not Path(".librarian").exists():
+        if not self.librarian_path.exists():
             self.setup()
             do_once = False
 
-        while True:
-            try:
+        # Saving happens once on exit rather than after every command
+        try:
+            while True:
                 try:
-                    query = prompt(">>> ").strip()
-                except KeyboardInterrupt:
-                    break
-                else:
-                    if do_once:
-                        self.setup()
-                        do_once = False
-
-                if query.startswith(":"):
-                    comps = query.split()
-                    command = comps[0].lower()
-                    match command:
-                        case ":add":
-                            try:
-                                self.add(query, comps)
-                            except KeyboardInterrupt:
-                                continue
-                        case ":clear" | ":cls":
-                            os.system("cls" if os.name == "nt" else "clear")
-                        case ":edit":
-                            try:
-                                self.edit(comps, search_results)
-                            except KeyboardInterrupt:
-                                continue
-                        case ":exam":
-                            self.exam()
-                        case ":fts":
-                            self.fts(query)
-                        case ":go":
-                            self.go(comps, search_results)
-                        case ":help":
-                            self.help()
-                            print()
-                        case ":info":
-                            self.info(comps, search_results)
-                        case ":question" | ":chat" | ":iwonder":
-                            self.chat(comps)
-                        case ":quit" | ":q" | ":exit" | ":shutdown" | ":logoff":
-                            break
-                        case ":random":
-                            self.random()
-                            print()
-                        case ":remove" | ":delete":
-                            self.remove(comps, search_results)
-                        case "stats":
-                            self.stats()
-                            print()
-                        case ":sync":
-                            try:
-                                self.sync()
-                            except KeyboardInterrupt:
+                    try:
+                        query = prompt(">>> ").strip()
+                    except KeyboardInterrupt:
+                        break
+                    else:
+                        if do_once:
+                            self.setup()
+                            do_once = False
+
+                    if query.startswith(":"):
+                        comps = query.split()
+                        command = comps[0].lower()
+                        match command:
+                            case ":add":
+                                try:
+                                    self.add(query, comps)
+                                except KeyboardInterrupt:
+                                    continue
+                            case ":clear" | ":cls":
+                                self.clear()
+                            case ":edit":
+                                try:
+                                    self.edit(comps, search_results)
+                                except KeyboardInterrupt:
+                                    continue
+                            case ":exam":
+                                self.exam()
+                            case ":fts":
+                                self.fts(query)
+                            case ":go":
+                                self.go(comps, search_results)
+                            case ":help":
+                                self.help()
+                                print()
+                            case ":info":
+                                self.info(comps, search_results)
+                            case ":question" | ":chat" | ":iwonder":
+                                self.chat(comps)
+                            case ":quit" | ":q" | ":exit" | ":shutdown" | ":logoff":
                                 break
-                            else:
-                                do_once = (
-                                    True  # Refresh the librarian instance after syncing
-                                )
-                        case _:
-                            raise NotImplementedError(f'unknown command: "{command}"')
-                    continue
-
-                # Normal semantic search
-                search_results = self.librarian.search(query)
-                self.print_results(search_results)
-            except Exception as err:
-                # raise
-                print(HTML(f"<ansired>Error: {err}</ansired>"))
-            finally:
-                self.close()
+                            case ":random":
+                                self.random()
+                                print()
+                            case ":remove" | ":delete":
+                                self.remove(comps, search_results)
+                            case "stats":
+                                self.stats()
+                                print()
+                            case ":sync":
+                                try:
+                                    self.sync()
+                                except KeyboardInterrupt:
+                                    break
+                                else:
+                                    do_once = (
+                                        True  # Refresh the librarian instance after syncing
+                                    )
+                            case _:
+                                raise NotImplementedError(f'unknown command: "{command}"')
+                        continue
+
+                    # Normal semantic search
+                    search_results = self.librarian.search(query)
+                    self.print_results(search_results)
+                except Exception as err:
+                    # raise
+                    print(HTML(f"<ansired>Error: {err}</ansired>"))
+        finally:
+            self.close()
 
         print(f"\nHave a nice day, {os.getlogin()}")  # Goodbye
 
     def slugify(self, isbn: str, title: str, extension: str):
-        clean_title = "-".join(title.lower().split())
-        slugified = re.sub(r"[^\w-]", "", clean_title)[
-            : 255 - len(isbn + extension + "-.")
-        ]
-        return f"{isbn}-{slugified}.{extension}"
-
-    def is_valid_isbn(self, isbn: str) -> bool:
-        """Checks if the given ISBN-13 is valid or not."""
-        if len(isbn) != 13:
+        slugified = _SLUG_RE.sub("", "-".join(title.lower().split()))
+        return f"{isbn}-{slugified[:255 - len(isbn) - len(extension) - 2]}.{extension}"
+
+    @staticmethod
+    def is_valid_isbn(isbn: str) -> bool:
+        """Checks if the given ISBN-10 or ISBN-13 is valid or not."""
+        if not isbn.isascii():
             return False
 
+        if len(isbn) == 10:
+            # ISBN-10 may end in an X, which stands for a check digit of 10
+            body, check = isbn[:9], isbn[9]
+            if not (body.isdigit() and (check.isdigit() or check in "Xx")):
+                return False
+            digits = [int(digit) for digit in body]
+            digits.append(10 if check in "Xx" else int(check))
+            # Digits are weighted from 10 down to 1
+            total = sum(digit * (10 - i) for i, digit in enumerate(digits))
+            return total % 11 == 0
+
+        if len(isbn) != 13 or not isbn.isdigit():
+            return False
+
+        # Digits alternate between a weight of 1 and 3
         total = sum(
-            [int(digit) for digit in range(0, 13, 2)]
-            + [int(digit) * 3 for digit in range(1, 13, 2)]
+            (digit - 48) * (1 + 2 * (i & 1))
+            for i, digit in enumerate(isbn.encode("ascii"))
         )
         return total % 10 == 0
 
+    @staticmethod
+    def to_isbn13(isbn: str) -> str:
+        """Converts a valid ISBN-10 to its ISBN-13 form, leaving ISBN-13s untouched."""
+        if len(isbn) != 10:
+            return isbn
+
+        body = "978" + isbn[:9]
+        total = sum(int(digit) * (1 + 2 * (i & 1)) for i, digit in enumerate(body))
+        return body + str(-total % 10)
+
     def get_metadata_info(
         self,
         filepath: Path = None,
@@ -453,8 +521,6 @@ class CmdApp:
                 filename="",
                 data=default_data,
             )
-            error_msg = lambda msg: HTML(f"<ansired>{msg}</ansired>")
-
             while True:
                 call_number = prompt("Call Number: ", default=metadata.call_number).strip()
                 if len(call_number) > 0:
@@ -462,17 +528,22 @@ class CmdApp:
                 print(error_msg("Call number needs to be specified, try again."))
 
             book = deepcopy(metadata.data)
+            # Users tend to retype the same ISBN after a failed attempt
+            isbn_exists = lru_cache(maxsize=128)(self.librarian.exists)
             while True:
-                isbn = re.sub(r"[^0-9]", "", prompt("ISBN: ", default=book.isbn))
-                zero_isbn = "0" * 13
+                isbn = _ISBN_RE.sub("", prompt("ISBN: ", default=book.isbn).upper())
                 if len(isbn) == 0:
-                    isbn = zero_isbn
+                    isbn = BLANK_ISBN
 
-                if isbn != zero_isbn and isbn in self.librarian:
+                if not self.is_valid_isbn(isbn):
+                    print(error_msg("Invalid ISBN, try again"))
+                    continue
+                # The catalog only indexes ISBN-13s, so an ISBN-10 has to be compared in that form
+                isbn = self.to_isbn13(isbn)
+                if isbn != BLANK_ISBN and isbn_exists(isbn):
                     print(error_msg(f"ISBN {isbn} already exists in the database"))
-                elif self.is_valid_isbn(isbn):
-                    break
-                print(error_msg("Invalid ISBN, try again"))
+                    continue
+                break
             book.isbn = isbn
 
             while True:
@@ -482,22 +553,22 @@ class CmdApp:
                 print(error_msg("Empty title, try again."))
             book.title = title
 
+            names = ", ".join(book.authors)
             while True:
-                names = str(book.authors).replace("'", "")[1:-1]
-                authors = [
-                    author.title().strip()
-                    for author in prompt("Authors: ", default=names).split(",")
-                ]
-                if len(authors[0]) > 0:
+                answer = prompt("Authors: ", default=names)
+                if answer == names:
+                    authors = book.authors  # already normalized
+                else:
+                    authors = [author.title().strip() for author in answer.split(",")]
+                if authors and len(authors[0]) > 0:
                     break
                 print(error_msg("Author list is too short, try again."))
             book.authors = authors
 
-            clean = lambda text: text.strip().title()
-            book.publisher = clean(prompt("Publisher: ", default=book.publisher))
-            book.series = clean(prompt("Series: ", default=book.series))
-            book.edition = clean(prompt("Edition: ", default=book.edition))
-            book.volume = clean(prompt("Volume: ", default=book.volume))
+            book.publisher = _maybe_clean(prompt("Publisher: ", default=book.publisher), book.publisher)
+            book.series = _maybe_clean(prompt("Series: ", default=book.series), book.series)
+            book.edition = _maybe_clean(prompt("Edition: ", default=book.edition), book.edition)
+            book.volume = _maybe_clean(prompt("Volume: ", default=book.volume), book.volume)
 
             while True:
                 try:
@@ -529,42 +600,42 @@ class CmdApp:
 
     def print_results(self, results: list[SearchResult]):
         columns = get_terminal_size().columns
+        wrapper = TextWrapper(
+            width=columns,
+            initial_indent="  “",
+            subsequent_indent="  ",
+            max_lines=2,
+            placeholder=" [...]”",
+        )
+        pad = len("Call Number")
+        sep = "-" * columns
 
-        for i, result in enumerate(results):
-            print(f"Result {i + 1}")
-            print("-" * columns)
-            contents = fill(
-                result.page_content,
-                width=columns,
-                initial_indent="  “",
-                subsequent_indent="  ",
-                max_lines=2,
-                placeholder=" [...]”",
-            )
+        lines = []
+        for i, result in enumerate(results, start=1):
+            contents = wrapper.fill(result.page_content)
             if not contents.endswith("”"):
                 contents += "”"
-            print(
-                contents,
-                end="\n\n",
-            )
+            lines += (f"Result {i}", sep, contents, "")
 
             metadata = result.metadata
             data = metadata.data
             if (mtype := result.metadata.type) == "book":
                 book = data
-                metadata = {
-                    "title": book.title,
-                    "authors": str(book.authors)[1:-1].replace("'", ""),
-                    "call_number": metadata.call_number,
-                    "page": result.page,
+                fields = {
+                    "Title": book.title,
+                    "Authors": ", ".join(book.authors),
+                    "Call Number": metadata.call_number,
+                    "Page": result.page,
                 }
             else:
                 raise NotImplementedError(f"unknown metadata type {mtype}")
 
-            for name, value in metadata.items():
-                formatted_name = name.replace("_", " ").title()
-                print(f"  {formatted_name:>{len('call_number')}} : {value}")
-            print()
+            lines += (f"  {name:>{pad}} : {value}" for name, value in fields.items())
+            lines.append("")
+
+        # A single print for all the results avoids a prompt_toolkit render per line
+        if lines:
+            print("\n".join(lines))
 
     def db_refresh_check(self):
         if self.librarian.is_database_mismatch():
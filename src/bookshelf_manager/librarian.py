@@ -3,29 +3,35 @@ Defines a class called Librarian that is designed to mimic a real librarian's jo
 It also defines a dataclass called Config that stores all configuration settings necessary for the librarian.
 """
 
-from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import json
 import os
-from dataclasses import asdict, dataclass, field
+from dataclasses import asdict, dataclass, field, fields
 from datetime import date
+from functools import lru_cache
 from pathlib import Path
 from shutil import move
 from typing import Literal
 
-from dacite import from_dict
 import fitz
+import orjson
 from prompt_toolkit import HTML
 from prompt_toolkit import print_formatted_text as print
 from send2trash import send2trash
 
 from .catalog_manager import CatalogManager, Metadata
-from .search_manager import SearchManager
-from .sync import SyncClient, SyncServer
+from .search_manager import SearchManager, extract_pages
 from .utils import Git, create_classification_cls, get_resource_path
 from llama_index.llms.openai_like import OpenAILike
 
+COVER_WIDTH = 600  # pixels
+AUTOSAVE_INTERVAL = 16  # changes
+REFRESH_BATCH_SIZE = 1024  # nodes embedded and inserted at once during a refresh
+REFRESH_WORKERS = 4  # text extraction threads
+OCR_REFRESH_WORKERS = 2  # each one loads its own Pix2Text model
 
-@dataclass
+
+@dataclass(slots=True)
 class Config:
     """Defines settings that the user can change if needed."""
 
@@ -37,7 +43,11 @@ class Config:
     )
     embed_model: str = "sentence-transformers/all-minilm-l6-v2"
 
-    index_denylist: list[str] = field(default_factory=list)
+    index_denylist: set[str] = field(default_factory=set)
+
+    def __post_init__(self):
+        # Stored as a list in config.json
+        self.index_denylist = set(self.index_denylist)
 
 
 @dataclass
@@ -52,17 +62,35 @@ class DocResult:
 
 def load_from_file(cls, path, default_config):
     """Loads from file if the path exists, else will create and return a blank instance of this class."""
-    path = Path(path)
-    if path.exists():
-        contents = path.read_text(encoding="utf-8")
-        return from_dict(cls, json.loads(contents))
-    else:
+    try:
+        contents = Path(path).read_bytes()
+    except FileNotFoundError:
         return default_config
 
+    values = orjson.loads(contents)
+    # Ignore keys left over from older versions instead of failing
+    names = {field.name for field in fields(cls)}
+    return cls(**{key: val for key, val in values.items() if key in names})
+
+
+@lru_cache(maxsize=4)
+def load_classification(path: str, type: str, mtime_ns: int):
+    """Parses the classification data at path, reusing the result until the file changes."""
+    # orjson parses the raw UTF-8 bytes, so skip decoding to str first
+    return create_classification_cls(type, Path(path).read_bytes())
+
+
+def _encode_set(obj):
+    if isinstance(obj, set):
+        return sorted(obj)  # stable output for version history
+    raise TypeError(f"cannot serialize {type(obj).__name__}")
+
 
 def save_to_file(path, config):
     """Dumps this dataclass into a JSON and then into a file."""
-    contents = json.dumps(asdict(config), indent=4, ensure_ascii=False)
+    # json keeps the 4-space indent of existing files, so saves don't reformat them in the
+    # version history; orjson is only used for loading
+    contents = json.dumps(asdict(config), indent=4, ensure_ascii=False, default=_encode_set)
     Path(path).write_text(contents, encoding="utf-8")
 
 
@@ -84,6 +112,8 @@ class Librarian:
         self.notes_path = self.librarian_path / "notes.json"
 
         self.config = load_from_file(Config, self.config_path, default_config)
+        self.notes_dirty = self.config_dirty = False
+        self.unsaved_changes = 0
 
         self.catalog_manager = CatalogManager(self.librarian_path)
         self.search_manager = SearchManager(
@@ -96,8 +126,11 @@ class Librarian:
         )
 
         type = self.config.classification_system
-        text = (self.librarian_path / f"{type}.json").read_text(encoding="utf-8")
-        self.classification_system = create_classification_cls(type, text)
+        path = self.librarian_path / f"{type}.json"
+        self.classification_system = load_classification(
+            str(path), type, path.stat().st_mtime_ns
+        )
+        self.known_dirs: set[Path] = set()
 
         # Notes taken by the librarian for making the user experience better
         self.librarian_notes = load_from_file(
@@ -110,15 +143,37 @@ class Librarian:
             self.do_git_commit()
 
     def close(self):
-        """Closes resources held by search manager."""
+        """Saves pending changes and closes resources held by search manager."""
+        self.flush()
+        self.search_manager.flush_removals()
+        self.search_manager.flush_index()
         self.search_manager.save()
 
+    def count_change(self):
+        """Counts a change to the library and autosaves every few changes instead of on each one."""
+        self.librarian_notes.changes += 1
+        self.notes_dirty = True
+        self.unsaved_changes += 1
+        if self.unsaved_changes >= AUTOSAVE_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """Writes the notes and config to disk if they have changed."""
+        if self.notes_dirty:
+            save_to_file(self.notes_path, self.librarian_notes)
+            self.notes_dirty = False
+        if self.config_dirty:
+            save_to_file(self.config_path, self.config)
+            self.config_dirty = False
+        self.unsaved_changes = 0
+
     def is_database_mismatch(self) -> bool:
         """
         Checks whether there is a mismatch between the catalog and index and returns the condition.
         """
+        denylist = self.config.index_denylist
         return self.search_manager.is_database_mismatch(
-            lambda metadata: metadata.id in self.config.index_denylist
+            lambda metadata: metadata.id in denylist
         )
 
     def do_git_commit(self):
@@ -126,15 +181,20 @@ class Librarian:
         git.stage(exclude_paths=[self.librarian_path / p for p in ("stores")])
         git.commit(date.today().isoformat())
         self.librarian_notes.changes = 0
-        save_to_file(self.notes_path, self.librarian_notes)  # autosave
+        self.notes_dirty = True
+        self.flush()
 
     def get_cover_image(self, path: Path):
         if path.suffix.lower().endswith("pdf"):
             pdf = fitz.open(path)
-            page = pdf.load_page(0)
-            pixels = page.get_pixmap(dpi=300)
-            buffer = BytesIO(pixels.tobytes(output="jpeg"))
-            cover_image = buffer.getvalue()
+            try:
+                page = pdf.load_page(0)
+                # Render to a fixed width rather than a fixed DPI, which is plenty for a cover
+                zoom = COVER_WIDTH / page.rect.width
+                pixels = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+                cover_image = pixels.tobytes(output="jpeg", jpg_quality=80)
+            finally:
+                pdf.close()
         else:
             cover_image = None
         return cover_image
@@ -157,9 +217,7 @@ class Librarian:
         if not path.exists():
             raise ValueError(f"{path} doesn't exist")
 
-        # Count as a change
-        self.librarian_notes.changes += 1
-        save_to_file(self.notes_path, self.librarian_notes)  # autosave
+        self.count_change()
 
         # Get cover image from PDF
         cover_image = self.get_cover_image(path)
@@ -171,15 +229,13 @@ class Librarian:
             # Add to search manager
             self.search_manager.add(path=path, id=metadata.id)
         except ValueError:
-            self.config.index_denylist.append(metadata.id)
-            save_to_file(self.config_path, self.config)  # autosave
+            self.config.index_denylist.add(metadata.id)
+            self.config_dirty = True
             raise
-        else:
-            self.search_manager.index()
         finally:
             # path stuff
             book_path = self.get_document_path(metadata)
-            os.makedirs(book_path.parent, exist_ok=True)
+            self.make_dirs(book_path.parent)
             move(path, book_path)
 
     def remove(self, id: str):
@@ -189,16 +245,14 @@ class Librarian:
         Args:
             id: The document denoted by ID (UUID)
         """
-        # Count as a change
-        self.librarian_notes.changes += 1
-        save_to_file(self.notes_path, self.librarian_notes)  # autosave
+        self.count_change()
 
         self.delete_book(id)
         self.catalog_manager.remove(id)
         self.search_manager.remove(id)
         if id in self.config.index_denylist:
             self.config.index_denylist.remove(id)
-            save_to_file(self.config_path, self.config)  # autosave
+            self.config_dirty = True
 
     def edit(self, modified_metadata: Metadata):
         """
@@ -207,20 +261,15 @@ class Librarian:
         Args:
             modified_metadata: The new, modified metadata
         """
-        # Count as a change
-        self.librarian_notes.changes += 1
-        save_to_file(self.notes_path, self.librarian_notes)  # autosave
+        self.count_change()
 
         old_file = self.info(modified_metadata.id)[0]
         old_path = self.get_document_path(old_file)
         new_path = self.get_document_path(modified_metadata)
 
-        os.makedirs(new_path.parent, exist_ok=True)
+        self.make_dirs(new_path.parent)
         move(old_path, new_path)
-        try:
-            os.removedirs(old_path.parent)
-        except OSError:
-            pass
+        self.remove_empty_dirs(old_path.parent)
 
         # Get cover image from PDF
         cover_image = self.get_cover_image(new_path)
@@ -231,25 +280,43 @@ class Librarian:
         """Refreshes the vector database component. Necessary if the embed model is changed, for instance."""
         self.search_manager.refresh()
 
-        paths_ids = self.get_paths_ids()
-        for path, id in paths_ids:
-            try:
-                print(f"Indexing '{path}'")
-                self.search_manager.add(
-                    path=path,
-                    id=id,
-                )
-            except ValueError as err:
-                print(HTML(f"<ansired>Indexing failure: {err}</ansired>"))
-                self.config.index_denylist.append(id)
-                save_to_file(self.config_path, self.config)  # autosave
-        self.search_manager.index()
+        # Text is extracted on worker threads while the chunking and embedding stay on
+        # this one. Threads avoid re-importing the package in every worker, and documents
+        # are handled as they finish so embedding overlaps the remaining extraction
+        nodes = []
+        limit = OCR_REFRESH_WORKERS if self.config.enable_enhanced_ocr else REFRESH_WORKERS
+        with ThreadPoolExecutor(max_workers=limit) as executor:
+            futures = {
+                executor.submit(
+                    extract_pages, path, self.config.enable_enhanced_ocr
+                ): (path, id)
+                for path, id in self.get_paths_ids()
+            }
+            for future in as_completed(futures):
+                path, id = futures[future]
+                try:
+                    print(f"Indexing '{path}'")
+                    nodes.extend(
+                        self.search_manager.create_nodes(path, id, future.result())
+                    )
+                except ValueError as err:
+                    print(HTML(f"<ansired>Indexing failure: {err}</ansired>"))
+                    self.config.index_denylist.add(id)
+                    self.config_dirty = True
+
+                if len(nodes) >= REFRESH_BATCH_SIZE:
+                    self.search_manager.add_nodes(nodes)
+                    nodes = []
+        self.search_manager.add_nodes(nodes)
+        self.search_manager.flush_index()
+        self.flush()
 
     def get_paths_ids(self) -> list[tuple]:
+        denylist = self.config.index_denylist
         return [
             (self.get_document_path(metadata), metadata.id)
             for metadata, cover_image in self.catalog_manager
-            if metadata.id not in self.config.index_denylist
+            if metadata.id not in denylist
         ]
 
     def search(self, query: str, search_type: Literal["semantic", "fts"] = "semantic"):
@@ -287,7 +354,13 @@ class Librarian:
             password: Contains the passphrase in order to send data with encryption
             server_addr: Is a tuple specifying either the server address (for the client to connect to) or the server binding address (typically set to 0.0.0.0:1230). Tuple example: ('0.0.0.0', 1230)
         """
+        from .sync import SyncClient, SyncServer
+
         home_dir = self.librarian_path.parent
+        # Write out pending changes now, so they aren't flushed over the synced files later
+        self.flush()
+        self.search_manager.flush_removals()
+        self.search_manager.flush_index()
         if is_client:
             client = SyncClient(password)
             client.start(
@@ -297,6 +370,12 @@ class Librarian:
                 exclude_patterns=["**/.DS_Store"],
                 strict=False,
             )
+            # The synced catalog entries, config and notes only exist on disk so far
+            self.catalog_manager.reload()
+            self.config = load_from_file(Config, self.config_path, self.config)
+            self.librarian_notes = load_from_file(
+                LibrarianNotes, self.notes_path, self.librarian_notes
+            )
         else:
             server = SyncServer(
                 password=password,
@@ -315,24 +394,34 @@ class Librarian:
 
     def get_document_path(self, metadata: Metadata) -> Path:
         """
-        Returns the path to the
+        Returns the path to the document described by metadata.
         """
-        return Path(
-            os.path.join(
-                self.librarian_path.parent,
-                self.classification_system.get_path(metadata.call_number),
-                metadata.filename,
-            )
+        return (
+            self.librarian_path.parent
+            / self.classification_system.get_path(metadata.call_number)
+            / metadata.filename
         )
 
     def delete_book(self, id: str):
         document = self.info(id)[0]
         doc_path = self.get_document_path(document)
         send2trash(doc_path)
+        self.remove_empty_dirs(doc_path.parent)
+
+    def make_dirs(self, directory: Path):
+        """Creates directory and its parents, skipping the syscalls for ones already made."""
+        if directory not in self.known_dirs:
+            os.makedirs(directory, exist_ok=True)
+            self.known_dirs.add(directory)
+
+    def remove_empty_dirs(self, directory: Path):
         try:
-            os.removedirs(doc_path.parent)
+            os.removedirs(directory)
         except OSError:
             pass
+        else:
+            # Some parents may be gone too, so forget them all
+            self.known_dirs.clear()
 
     def info(self, id: str) -> tuple:
         """
@@ -357,4 +446,4 @@ class Librarian:
         return self.info(id)
 
     def __contains__(self, id: str):
-        self.exists(id)
+        return self.exists(id)
@@ -42,4 +42,7 @@ def start_mcp_server(
     mcp.resource(uri="librarian://get_all_documents")(librarian.get_all_documents)
     mcp.resource(uri="librarian://get_library_path")(get_library_path)
 
-    mcp.run(transport="streamable-http")
+    try:
+        mcp.run(transport="streamable-http")
+    finally:
+        librarian.close()  # write out autosaves still pending
@@ -9,13 +9,13 @@ Intelligence may involve curiousity, but curiousity is random (appearing out of
 
 import base64
 import contextlib
-import json
 import logging
 import os
 import re
 import sys
+import threading
 import warnings
-from dataclasses import asdict, dataclass
+from dataclasses import dataclass
 from pathlib import Path
 from shutil import rmtree
 from textwrap import dedent
@@ -41,10 +41,16 @@ from semchunk import chunkerify
 from .catalog_manager import Book, CatalogManager, Metadata
 from .utils import ask_image
 from llama_index.core import Settings
-from pix2text import Pix2Text
 
+_PDF_EXTS = (".pdf",)
+_WS_RE = re.compile(r"\s+")
+INDEX_THRESHOLD = 500  # rows added before the indices are rebuilt
+REMOVE_BATCH_SIZE = 500  # ids per delete query
+ADD_BATCH_SIZE = 256  # pages chunked and inserted together when adding a document
+CHUNK_SIZE = 256  # tokens per chunk
 
-@dataclass
+
+@dataclass(slots=True)
 class SearchResult:
     metadata: Metadata
     cover_image: str
@@ -52,6 +58,64 @@ class SearchResult:
     page_content: str
 
 
+_stderr_muted = False
+
+
+def mute_stderr():
+    """
+    Silences stderr and warnings once per process so prompt_toolkit can work.
+    Set LIBRARIAN_QUIET=0 to keep them, e.g. when debugging or profiling.
+    """
+    global _stderr_muted
+    if _stderr_muted or os.environ.get("LIBRARIAN_QUIET", "1") == "0":
+        return
+    sys.stderr = open(os.devnull, "w")
+    warnings.simplefilter("ignore")
+    _stderr_muted = True
+
+
+_pix2text = threading.local()
+
+
+def get_pix2text():
+    """Returns the Pix2Text model of the calling thread, loading it on first use."""
+    p2t = getattr(_pix2text, "model", None)
+    if p2t is None:
+        from pix2text import Pix2Text  # heavy, and only needed for enhanced OCR
+
+        p2t = _pix2text.model = Pix2Text.from_config()
+    return p2t
+
+
+def iter_pages(path: Path, enable_enhanced_ocr: bool):
+    """Yields the whitespace-normalized text of each page in the PDF located at path."""
+    if path.suffix.lower() not in _PDF_EXTS:
+        raise ValueError("librarian does not support indexing files other than PDF")
+
+    pdf = pymupdf.open(path)
+    try:
+        if enable_enhanced_ocr:
+            p2t = get_pix2text()
+
+        for page in pdf:
+            if enable_enhanced_ocr:
+                doc = p2t.recognize_pdf(path, page_numbers=[page])
+                text = doc.to_markdown("output-md")
+            else:
+                text = page.get_text()
+            yield _WS_RE.sub(" ", text).strip()
+    finally:
+        pdf.close()
+
+
+def extract_pages(path: Path, enable_enhanced_ocr: bool) -> list[str]:
+    """
+    Returns the text of every page in the PDF located at path.
+    It is a module-level function so that it can run in a worker thread.
+    """
+    return list(iter_pages(path, enable_enhanced_ocr))
+
+
 class SearchManager:
 
     def __init__(
@@ -63,8 +127,7 @@ class SearchManager:
         catalog_manager: CatalogManager,
         enable_enhanced_ocr: bool,
     ):
-        sys.stderr = open(os.devnull, "w")  # so prompt_toolkit can work
-        warnings.simplefilter("ignore")
+        mute_stderr()
 
         self.embed_path = embed_path
         self.catalog_manager = catalog_manager
@@ -74,14 +137,12 @@ class SearchManager:
 
         self.create_embed_client()
         
+        self.unindexed_rows = 0
+        self.pending_removals: set[str] = set()
         self.stores_path = path / "stores"
         self.llamaindex_dir = self.stores_path / "llamaindex"
         self.create_stores(self.stores_path)
 
-        self.get_len_tokens = lambda text: len(
-            Settings.embed_model._model.tokenizer.tokenize(text)
-        )
-
         # memory stuff
         blocks = [
             FactExtractionMemoryBlock(
@@ -139,7 +200,18 @@ class SearchManager:
 
     def create_embed_client(self):
         with contextlib.redirect_stdout(None):
-            Settings.embed_model = HuggingFaceEmbedding(model_name=str(self.embed_path))
+            # Larger batches let the model embed many chunks per forward pass
+            Settings.embed_model = HuggingFaceEmbedding(
+                model_name=str(self.embed_path), embed_batch_size=64
+            )
+
+        # Bound once here since the chunker calls this for every candidate split;
+        # encode skips building the list of token strings that tokenize returns
+        encode = Settings.embed_model._model.tokenizer.encode
+        self.get_len_tokens = lambda text: len(encode(text, add_special_tokens=False))
+
+        # Built on first use and then kept for every document embedded with this model
+        self.chunker = None
 
     def save(self):
         self.llamaindex.storage_context.persist(self.llamaindex_dir)
@@ -149,23 +221,39 @@ class SearchManager:
         self.create_embed_client()
         rmtree(self.stores_path)
         self.create_stores(self.stores_path)
+        self.unindexed_rows = 0
+        self.pending_removals.clear()
 
     def is_database_mismatch(self, is_ignored) -> bool:
+        self.flush_removals()
         if not "documents" in list(self.db.table_names()):
             return any(not is_ignored(meta) for meta, cover_image in self.catalog_manager)
 
         tbl = self.db.open_table("documents")
+        indexed_ids = self.get_indexed_ids(tbl)
+        # Nodes left behind when queued removals were never flushed, e.g. after a crash
+        if any(id not in self.catalog_manager.entries for id in indexed_ids):
+            return True
         return any(
-            meta.filename.lower().endswith(".pdf")
-            and not self.exists(meta, tbl)
+            Path(meta.filename).suffix.lower() in _PDF_EXTS
+            and meta.id not in indexed_ids
             and not is_ignored(meta)
             for meta, cover_image in self.catalog_manager
         )
 
-    def exists(self, metadata: Metadata, tbl):
-        return tbl.count_rows(filter=f"`metadata`.`id` = '{metadata.id}'") > 0
+    def get_indexed_ids(self, tbl) -> set[str]:
+        """Returns the ids of every document in the table with a single scan."""
+        num_rows = tbl.count_rows()
+        if num_rows == 0:
+            return set()
+        # Pull just the id column as Arrow instead of building a dict per row
+        table = tbl.search().select(["metadata"]).limit(num_rows).to_arrow()
+        ids = table["metadata"].combine_chunks().field("id")
+        return set(ids.to_pylist())
 
     def index(self) -> bool:
+        self.flush_removals()
+        self.unindexed_rows = 0
         vectorstore = self.db.open_table("documents")
         vectorstore.create_fts_index("text", language="English", replace=True)
 
@@ -176,49 +264,104 @@ class SearchManager:
         else:
             return False
 
+    def create_nodes(
+        self,
+        path: Path,
+        id: str,
+        texts: list[str],
+        start: int = 1,
+        strict: bool = True,
+    ) -> list[TextNode]:
+        """
+        Chunks the page texts of the document at path into nodes tagged with its id and page number.
+        The first text is numbered start; strict raises if no text could be extracted.
+        """
+        if self.chunker is None:
+            # Checked here so that a short context length only blocks adding documents
+            if Settings.embed_model._model.tokenizer.model_max_length < CHUNK_SIZE:
+                raise RuntimeError(f"{self.embed_path} has a context length below {CHUNK_SIZE}")
+            self.chunker = chunkerify(self.get_len_tokens, CHUNK_SIZE)
+
+        # chunk every page in one call; overlap should be 10%-20% max
+        pages_chunks = self.chunker(texts, overlap=0.10)
+        nodes = [
+            TextNode(text=chunk, metadata={"id": id, "page": num})
+            for num, chunks in enumerate(pages_chunks, start=start)
+            for chunk in chunks
+        ]
+        if strict and not nodes:
+            raise RuntimeError(f"could not extract text from '{path}'")
+        return nodes
+
     def add(
         self,
         path: Path,
         id: str,
     ):
-        if not path.name.endswith(".pdf"):
-            raise ValueError("librarian does not support indexing files other than PDF")
-
-        n_ctx = 256
-        if Settings.embed_model._model.tokenizer.model_max_length < n_ctx:
-            raise RuntimeError(f"{self.embed_path} has a context length below {n_ctx}")
-        chunker = chunkerify(
-            self.get_len_tokens,
-            n_ctx,
-        )
-
-        pdf = pymupdf.open(path)
-        if self.enable_enhanced_ocr:
-            p2t = Pix2Text.from_config()
-        
-        nodes = []
-        for num, page in enumerate(pdf, start=1):
-            if self.enable_enhanced_ocr:
-                doc = p2t.recognize_pdf(path, page_numbers=[page])
-                text = doc.to_markdown("output-md")
-            else:
-                text = page.get_text()
+        # Stream the pages so that only one batch is held in memory at a time,
+        # chunking each batch of pages in a single call
+        pages = []
+        start = 1
+        wrote_any = False
+        try:
+            for text in iter_pages(path, self.enable_enhanced_ocr):
+                pages.append(text)
+                if len(pages) >= ADD_BATCH_SIZE:
+                    nodes = self.create_nodes(path, id, pages, start=start, strict=False)
+                    self.add_nodes(nodes)
+                    wrote_any = wrote_any or bool(nodes)
+                    start += len(pages)
+                    pages = []
+            if pages:
+                nodes = self.create_nodes(path, id, pages, start=start, strict=False)
+                self.add_nodes(nodes)
+                wrote_any = wrote_any or bool(nodes)
+        except BaseException:
+            # Don't leave part of the document behind in the store
+            if wrote_any:
+                self.remove(id)
+                self.flush_removals()
+            raise
+        if not wrote_any:
+            raise RuntimeError(f"could not extract text from '{path}'")
 
-            clean_content = " ".join(text.split())
-            chunks = chunker(
-                clean_content, overlap=0.10
-            )  # overlap should be 10%-20% max
-            for chunk in chunks:
-                nodes.append(TextNode(text=chunk, metadata={"id": id, "page": num}))
+    def add_nodes(self, nodes: list[TextNode]):
+        """Inserts the nodes of one or more documents into the index in a single batch."""
         if nodes:
             self.llamaindex.insert_nodes(nodes)
             self.save()
-        else:
-            raise RuntimeError(f"could not extract text from '{path}'")
+            # Rebuilding the indices is expensive, so only do it once enough rows pile up
+            self.unindexed_rows += len(nodes)
+            if self.unindexed_rows >= INDEX_THRESHOLD:
+                self.index()
+
+    def flush_index(self):
+        """Indexes any rows added since the last index build."""
+        if self.unindexed_rows:
+            self.index()
 
     def remove(self, id: str):
-        filters = MetadataFilters(filters=[ExactMatchFilter(key="id", value=id)])
-        self.llamaindex.delete_nodes(filters=filters)
+        self.remove_many([id])
+
+    def remove_many(self, ids):
+        """Queues documents for removal; they are deleted together before the next read."""
+        self.pending_removals.update(ids)
+
+    def flush_removals(self):
+        """Deletes the queued documents with as few delete queries as possible."""
+        if not self.pending_removals:
+            return
+        ids = sorted(self.pending_removals)
+        for start in range(0, len(ids), REMOVE_BATCH_SIZE):
+            filters = MetadataFilters(
+                filters=[
+                    ExactMatchFilter(key="id", value=id)
+                    for id in ids[start : start + REMOVE_BATCH_SIZE]
+                ],
+                condition=FilterCondition.OR,
+            )
+            self.llamaindex.delete_nodes(filters=filters)
+        self.pending_removals.clear()
         self.save()
 
     def search_for_books(self, query: str) -> str:
@@ -226,6 +369,7 @@ class SearchManager:
         Searches a vector database full of books for relevant text chunks based on the query.
         The result contains the book's metadata, text chunk, and the page number.
         """
+        self.flush_removals()
         results = self.llamaindex.as_retriever().retrieve(query)
         top_results = [result for result in results if result.score > 0.1]
         search_results = self.get_search_results(type="nodes", results=top_results)
@@ -253,35 +397,51 @@ class SearchManager:
     def semantic_search(
         self, query: str, filters: MetadataFilters | None = None, k: int = 4
     ) -> list[SearchResult]:
-        retriever = self.llamaindex.as_retriever(filters=filters)
+        self.flush_removals()
+        # over-fetch so that k results are still left after the score cutoff
+        retriever = self.llamaindex.as_retriever(
+            filters=filters, similarity_top_k=k * 2
+        )
         results = retriever.retrieve(query)
-        top_results = [result for result in results if result.score >= 0.1]
+        top_results = [result for result in results if result.score >= 0.1][:k]
         return self.get_search_results(type="nodes", results=top_results)
 
     def fts_search(self, query: str, k: int = 4) -> list[SearchResult]:
+        self.flush_removals()
+        self.flush_index()  # so that recently added documents can be found
         table = self.db.open_table("documents")
-        rows = table.search(query).limit(k).tolist()
+        rows = table.search(query).select(["text", "metadata"]).limit(k).tolist()
         return self.get_search_results(type="rows", results=rows)
 
     def get_search_results(self, type: str, results) -> list[SearchResult]:
-        search_results = []
-        for result in results:
-            if type == "nodes":
-                early_metadata, text = result.metadata, result.text
-                id, page = early_metadata["id"], early_metadata["page"]
-            elif type == "rows":
-                text = result.get("text")
-                early_metadata = result["metadata"]
-                id, page = early_metadata["id"], early_metadata["page"]
-            else:
-                raise NotImplementedError(f"unknown type {type}")
+        if type == "nodes":
+            pairs = [(result.metadata, result.text) for result in results]
+        elif type == "rows":
+            pairs = [(result["metadata"], result.get("text")) for result in results]
+        else:
+            raise NotImplementedError(f"unknown type {type}")
 
-            metadata, cover_image_path = self.catalog_manager.get(id)
+        # Several chunks often come from the same document, so look each one up once
+        documents = {}
+        search_results = []
+        for early_metadata, text in pairs:
+            id = early_metadata["id"]
+            if id not in documents:
+                try:
+                    metadata, cover_image_path = self.catalog_manager.get(id)
+                except LookupError:
+                    # removed from the catalog, but its nodes were never deleted
+                    documents[id] = None
+                else:
+                    documents[id] = (metadata, str(cover_image_path))
+            if documents[id] is None:
+                continue
+            metadata, cover_image = documents[id]
             search_results.append(
                 SearchResult(
                     metadata=metadata,
-                    cover_image=str(cover_image_path),
-                    page=page,
+                    cover_image=cover_image,
+                    page=early_metadata["page"],
                     page_content=text,
                 )
             )
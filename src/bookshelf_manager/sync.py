@@ -1,15 +1,32 @@
-import base64
 import json
+from concurrent.futures import ThreadPoolExecutor
 import os
 import socket
 import struct
 import unicodedata
-from hashlib import sha256
+from hashlib import pbkdf2_hmac, sha256
 from pathlib import Path
 
-from cryptography.fernet import Fernet
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from platformdirs import user_cache_dir
+
+
+NONCE_SIZE = 12
+HASH_CHUNK_SIZE = 2**20
+FILE_FRAME_SIZE = 2**20  # plaintext bytes per encrypted file frame
+SOCKET_BUFFER_SIZE = 4 * 2**20
+HASH_WORKERS = 4  # hashlib releases the GIL, so files can be hashed in parallel
+
+
+def hash_file(path: Path) -> str:
+    """Returns the SHA-256 of the file at path, reading it in chunks to keep memory flat."""
+    hash = sha256()
+    with open(path, "rb", buffering=0) as file:
+        buffer = bytearray(HASH_CHUNK_SIZE)
+        view = memoryview(buffer)
+        while size := file.readinto(buffer):
+            hash.update(view[:size])
+    return hash.hexdigest()
 
 
 class SocketClosedError(RuntimeError):
@@ -20,25 +37,68 @@ class PasswordMismatchError(RuntimeError):
     pass
 
 
+class HashCache:
+    """Remembers file hashes by modification time and size so unchanged files are not read again."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        try:
+            self.entries = json.loads(path.read_bytes())
+        except (FileNotFoundError, ValueError):
+            self.entries = {}
+        self.dirty = False
+
+    def get(self, path: Path) -> str:
+        stat = path.stat()
+        key = str(path.resolve())
+        entry = self.entries.get(key)
+        if entry and entry[:2] == [stat.st_mtime_ns, stat.st_size]:
+            return entry[2]
+        hash = hash_file(path)
+        self.put(path, hash)
+        return hash
+
+    def put(self, path: Path, hash: str):
+        stat = path.stat()
+        self.entries[str(path.resolve())] = [stat.st_mtime_ns, stat.st_size, hash]
+        self.dirty = True
+
+    def save(self):
+        if self.dirty:
+            tmp_path = self.path.with_name(self.path.name + ".tmp")
+            tmp_path.write_text(json.dumps(self.entries))
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+
+
 class SocketCommunication:
 
     def __init__(self, password: str):
         self.password = unicodedata.normalize("NFC", password).encode()
-        self.f = None
+        self.aead = None
+        cache_dir = user_cache_dir(
+            appname="librarian", appauthor="suncloudsmoon", ensure_exists=True
+        )
+        self.hash_cache = HashCache(Path(cache_dir) / "hashes.json")
 
     def setup_key(self, salt: bytes) -> bytes:
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(), length=32, salt=salt, iterations=1_200_000
-        )
-        key = base64.urlsafe_b64encode(kdf.derive(self.password))
-        self.f = Fernet(key)
+        # hashlib calls straight into OpenSSL's PBKDF2, which reuses the HMAC pad state
+        key = pbkdf2_hmac("sha512", self.password, salt, 1_200_000, dklen=32)
+        self.aead = AESGCM(key)
         return key
 
-    def encrypt(self, data: bytes) -> bytes:
-        return self.f.encrypt(data)
+    def encrypt(self, data: bytes, associated_data: bytes | None = None) -> bytes:
+        nonce = os.urandom(NONCE_SIZE)
+        return nonce + self.aead.encrypt(nonce, data, associated_data)
 
-    def decrypt(self, data: bytes) -> bytes:
-        return self.f.decrypt(data)
+    def decrypt(self, data: bytes, associated_data: bytes | None = None) -> bytes:
+        data = memoryview(data)
+        return self.aead.decrypt(data[:NONCE_SIZE], data[NONCE_SIZE:], associated_data)
+
+    def tune_socket(self, clientsocket: socket.socket):
+        # Larger kernel buffers keep multi-megabyte transfers from stalling on small windows
+        clientsocket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+        clientsocket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
 
     def server_handshake(self, clientsocket: socket.socket):
         salt = os.urandom(16)
@@ -55,21 +115,33 @@ class SocketCommunication:
         if hash != sha256(key).hexdigest():
             raise PasswordMismatchError()
 
-    def send_num_bytes(self, clientsocket: socket.socket, amount: int):
-        if amount < 0 or amount > 2**64:
+    def pack_num_bytes(self, amount: int) -> bytes:
+        if amount < 0 or amount >= 2**64:
             raise ValueError(f"invalid amount {amount}")
+        return struct.pack(">Q", amount)
 
-        data = struct.pack(">Q", amount)
-        clientsocket.sendall(data)
+    def send_num_bytes(self, clientsocket: socket.socket, amount: int):
+        clientsocket.sendall(self.pack_num_bytes(amount))
 
     def send_bytes(
-        self, clientsocket: socket.socket, data: bytes, encrypt: bool = True
+        self,
+        clientsocket: socket.socket,
+        data: bytes,
+        encrypt: bool = True,
+        associated_data: bytes | None = None,
     ):
-        data = self.encrypt(data) if encrypt else data
-        size = len(data)
-        self.send_num_bytes(clientsocket, size)
-        data = struct.pack(f">{size}s", data)
-        clientsocket.sendall(data)
+        data = self.encrypt(data, associated_data) if encrypt else data
+        header = self.pack_num_bytes(len(data))
+        if hasattr(clientsocket, "sendmsg"):
+            # Send the length prefix and the payload together without copying the payload
+            sent = clientsocket.sendmsg([header, data])
+            if sent < len(header):
+                clientsocket.sendall(header[sent:])
+                sent = len(header)
+            if sent < len(header) + len(data):
+                clientsocket.sendall(memoryview(data)[sent - len(header) :])
+        else:
+            clientsocket.sendall(header + data)
 
     def send_info(
         self, clientsocket: socket.socket, packet_info: dict, encrypt: bool = True
@@ -78,7 +150,6 @@ class SocketCommunication:
         self.send_bytes(clientsocket, data, encrypt)
 
     def send_file(self, clientsocket: socket.socket, filepath: Path):
-        file = filepath.read_bytes()
         self.send_info(
             clientsocket,
             {
@@ -86,34 +157,54 @@ class SocketCommunication:
                 "path": str(filepath),
             },
         )
-        self.send_bytes(clientsocket, file)
+        # Encrypt the file frame by frame so that it is never held in memory as a whole.
+        # Each frame is bound to its path and index, and an empty frame marks the end.
+        with open(filepath, "rb") as file:
+            index = 0
+            while frame := file.read(FILE_FRAME_SIZE):
+                self.send_bytes(
+                    clientsocket,
+                    frame,
+                    associated_data=self.get_frame_label(str(filepath), index),
+                )
+                index += 1
+        label = self.get_frame_label(str(filepath), index)
+        self.send_bytes(clientsocket, b"", associated_data=label)
+
+    def get_frame_label(self, path: str, index: int) -> bytes:
+        """
+        Associated data that ties a file frame to its position in one particular file.
+        path is the string sent in the file's info packet, so both ends agree on it.
+        """
+        return self.pack_num_bytes(index) + path.encode()
+
+    def receive_exact(self, clientsocket: socket.socket, size: int) -> bytearray:
+        """Reads exactly size bytes straight into a preallocated buffer."""
+        data = bytearray(size)
+        view = memoryview(data)
+        offset = 0
+        while offset < size:
+            received = clientsocket.recv_into(view[offset:], min(size - offset, 2**20))
+            if received == 0:
+                raise SocketClosedError()
+            offset += received
+        return data
 
     def receive_num_bytes(
         self,
         clientsocket: socket.socket,
     ) -> int:
-        data = bytearray()
-        while (datalen := len(data)) < 8:
-            packets = clientsocket.recv(min(8 - datalen, 8))
-            if packets == b"":
-                raise SocketClosedError()
-            data.extend(packets)
-        converted_data = struct.unpack(">Q", data)[0]
-        return int(converted_data)
+        return struct.unpack(">Q", self.receive_exact(clientsocket, 8))[0]
 
-    def receive_bytes(self, clientsocket: socket.socket, decrypt: bool = True):
+    def receive_bytes(
+        self,
+        clientsocket: socket.socket,
+        decrypt: bool = True,
+        associated_data: bytes | None = None,
+    ):
         msglen = self.receive_num_bytes(clientsocket)
-
-        all_data = bytearray()
-        while (datalen := len(all_data)) < msglen:
-            data = clientsocket.recv(min(msglen - datalen, 2**20))
-            if data == b"":
-                raise SocketClosedError()
-            all_data.extend(data)
-
-        converted_data = struct.unpack(f">{msglen}s", all_data)[0]
-        decrypted_data = self.decrypt(converted_data) if decrypt else converted_data
-        return decrypted_data
+        data = self.receive_exact(clientsocket, msglen)
+        return self.decrypt(data, associated_data) if decrypt else bytes(data)
 
     def receive_info(self, clientsocket: socket.socket, decrypt: bool = True) -> dict:
         data = self.receive_bytes(clientsocket, decrypt)
@@ -124,8 +215,24 @@ class SocketCommunication:
         info = self.receive_info(clientsocket)
         if info["type"] == "file":
             path = Path(info["path"])
-            file = self.receive_bytes(clientsocket)
-            path.write_bytes(file)
+            # Keep the existing copy intact until the whole file has been authenticated
+            part_path = path.with_name(path.name + ".part")
+            try:
+                with open(part_path, "wb") as file:
+                    index = 0
+                    while frame := self.receive_bytes(
+                        clientsocket,
+                        associated_data=self.get_frame_label(info["path"], index),
+                    ):
+                        file.write(frame)
+                        index += 1
+            except SocketClosedError as err:
+                part_path.unlink(missing_ok=True)
+                raise RuntimeError(f"connection closed while receiving {path}") from err
+            except BaseException:
+                part_path.unlink(missing_ok=True)
+                raise
+            os.replace(part_path, path)
         else:
             raise TypeError(f"unknown type {info["type"]}")
 
@@ -145,11 +252,13 @@ class SyncServer(SocketCommunication):
 
     def start(self, directory: Path):
         (clientsocket, port) = self.server_socket.accept()
+        self.tune_socket(clientsocket)
         self.server_handshake(clientsocket)
 
         directory.mkdir(exist_ok=True)
         os.chdir(directory)
         root = Path(".")
+        executor = ThreadPoolExecutor(max_workers=HASH_WORKERS)
         try:
             info = self.receive_info(clientsocket)
             filepaths = [path for path in root.rglob("*") if path.is_file()]
@@ -158,9 +267,9 @@ class SyncServer(SocketCommunication):
                     clientsocket, {"paths": [str(path) for path in filepaths]}
                 )
 
-            for path in filepaths:
-                file = path.read_bytes()
-                hash = sha256(file).hexdigest()
+            # Upcoming files are hashed while the current one is negotiated and sent
+            hashes = executor.map(self.hash_cache.get, filepaths)
+            for path, hash in zip(filepaths, hashes):
                 self.send_info(clientsocket, {"path": str(path), "hash": hash})
                 info = self.receive_info(clientsocket)
                 if info["wanted"]:
@@ -168,6 +277,8 @@ class SyncServer(SocketCommunication):
         except KeyboardInterrupt:
             pass
         finally:
+            executor.shutdown(cancel_futures=True)
+            self.hash_cache.save()
             clientsocket.shutdown(socket.SHUT_RDWR)
             clientsocket.close()
         self.server_socket.close()
@@ -181,10 +292,11 @@ class SyncClient(SocketCommunication):
             family=socket.AF_INET, type=socket.SOCK_STREAM
         )
 
-    def get_file(self, filepath: Path):
+    def get_file(self, filepath: Path, hash: str):
         self.send_info(self.client_socket, {"wanted": True})
         filepath.parent.mkdir(parents=True, exist_ok=True)
         self.receive_file(self.client_socket, filepath)
+        self.hash_cache.put(filepath, hash)
         print(f"Synced {filepath}")
 
     def refuse_file(self):
@@ -202,23 +314,27 @@ class SyncClient(SocketCommunication):
         os.chdir(directory)
         root = Path(".")
 
+        self.tune_socket(self.client_socket)
         self.client_socket.connect(server_addr)
         self.client_handshake(self.client_socket)
 
         self.send_info(self.client_socket, {"strict": strict})
+        excluded = set(exclude_paths)
         if strict:
             path_info = self.receive_info(self.client_socket)
-            paths = [Path(path) for path in path_info["paths"]]
+            paths = {Path(path) for path in path_info["paths"]}
 
             # Delete files
-            pathiter = root.rglob("*")
-            for path in pathiter:
-                if path.is_file() and path not in paths and path not in exclude_paths:
+            local_paths = list(root.rglob("*"))
+            for path in local_paths:
+                if path.is_file() and path not in paths and path not in excluded:
                     path.unlink()
 
-            # Delete empty directories
-            for path in pathiter:
-                if path.exists() and path.is_dir() and path not in exclude_paths:
+            # Delete empty directories, deepest first so that parents are empty by then
+            directories = [path for path in local_paths if path.is_dir()]
+            directories.sort(key=lambda path: len(path.parts), reverse=True)
+            for path in directories:
+                if path not in excluded:
                     try:
                         path.rmdir()
                     except OSError:
@@ -229,13 +345,12 @@ class SyncClient(SocketCommunication):
                 filepath = Path(info["path"])
                 
                 excluded_pattern = any(filepath.full_match(pattern) for pattern in exclude_patterns)
-                if filepath not in exclude_paths and not excluded_pattern:
+                if filepath not in excluded and not excluded_pattern:
                     if not filepath.exists():
-                        self.get_file(filepath)
+                        self.get_file(filepath, info["hash"])
                     else:
-                        hash = sha256(filepath.read_bytes()).hexdigest()
-                        if info["hash"] != hash:
-                            self.get_file(filepath)
+                        if info["hash"] != self.hash_cache.get(filepath):
+                            self.get_file(filepath, info["hash"])
                         else:
                             self.refuse_file()
                 else:
@@ -243,5 +358,6 @@ class SyncClient(SocketCommunication):
         except SocketClosedError:
             pass
         finally:
+            self.hash_cache.save()
             self.client_socket.shutdown(socket.SHUT_RDWR)
             self.client_socket.close()
@@ -23,11 +23,12 @@ Brainstorm
 """
 
 import base64
+import html
 import os
 import random
-import re
 import tempfile
 from dataclasses import dataclass
+from hashlib import sha256
 from pathlib import Path
 from textwrap import dedent
 from typing import Literal
@@ -38,11 +39,66 @@ import pypandoc
 import yaml
 from openai import OpenAI
 from pikepdf import Pdf
+from platformdirs import user_cache_dir
 from pydantic import BaseModel, Field
 
 from .catalog_manager import Book
 from .librarian import Librarian
-from .utils import ask_image
+
+
+# Control characters that break LaTeX, except tab, newline and carriage return
+_CONTROL_CHARS = dict.fromkeys(
+    [*range(0x00, 0x09), 0x0B, 0x0C, *range(0x0E, 0x20), 0x7F]
+)
+
+_TITLE_PAGE = dedent(
+    r"""
+    \thispagestyle{{empty}}
+    
+    \vspace*{{\fill}}
+    \begin{{center}}
+    {{\Huge \textbf{{{title}}}}}
+    \end{{center}}
+    \vspace*{{\fill}}
+    """
+)
+_NEW_PAGE = r"\newpage" + "\n"
+_TITLE_CSS = (
+    "p {font-family: sans-serif; font-size: 28pt; font-weight: bold; text-align: center;}"
+)
+PAGES_PER_BOOK = 5  # pages sampled for questions from each book
+PAGE_MARGIN = 72  # one inch
+ANSWER_KEY_TITLE_SIZE = 24
+ANSWER_KEY_HEADING_SIZE = 16
+ANSWER_KEY_TEXT_SIZE = 12
+
+
+def wrap_text(
+    text: str, fontname: str, fontsize: float, max_width: float
+) -> list[str]:
+    """Greedily breaks text into lines no wider than max_width when drawn in the given font."""
+    lines = []
+    line = ""
+    for word in text.split():
+        candidate = f"{line} {word}" if line else word
+        if line and fitz.get_text_length(candidate, fontname, fontsize) > max_width:
+            lines.append(line)
+            line = word
+        else:
+            line = candidate
+    lines.append(line)
+    return lines
+
+
+def merge_page_runs(page_indices: list[int]) -> list[tuple[int, int]]:
+    """Merges sorted page indices into (first, last) runs of consecutive pages; repeats start a new run."""
+    runs = []
+    for index in page_indices:
+        if runs and index == runs[-1][1] + 1:
+            runs[-1] = (runs[-1][0], index)
+        else:
+            runs.append((index, index))
+    return runs
 
 
 class Question(BaseModel):
@@ -68,6 +124,13 @@ class Question(BaseModel):
     )
 
 
+class QuestionSet(BaseModel):
+    questions: list[Question] = Field(
+        title="Questions",
+        description="One question per page image, in the same order as the images",
+    )
+
+
 @dataclass
 class QuestionInfo:
     question: Question
@@ -89,6 +152,7 @@ class Teacher:
         self.model_name = model_name
         self.system_prompt = (
             "Your job is to extract questions and answers from a page selected from a textbook for preparing an exam for a college student. "
+            "Several pages may be given as separate images; return exactly one question per image, in the same order as the images. "
             "The question(s) should be extracted from the text only. For each question, there should be 4 choices populated. "
             "If the question refers to any content in the page, some context must be embedded within the question to make it easier for the reader to find the content. "
             "The correct choice should not have any special formatting that indicates that it is the correct answer. "
@@ -101,6 +165,15 @@ class Teacher:
             "LaTeX should be used within markdown only for representing math symbols and should be wrapped with math delimiters (e.g. $a^b$). "
             "Because you are outputting JSON, make sure to escape all backslahes (e.g. \\\\frac{})."
         )
+        self.cache_dir = (
+            Path(
+                user_cache_dir(
+                    appname="librarian", appauthor="suncloudsmoon", ensure_exists=True
+                )
+            )
+            / "questions"
+        )
+        self.cache_dir.mkdir(exist_ok=True)
 
     def export_exam(self, filetype: str, filepath: Path, exam: list[ExamSection]):
         if filetype == "pdf":
@@ -176,57 +249,52 @@ class Teacher:
             page_count = page_count + 1
 
             # Appendix
-            for section in exam:
-                book = section.book
-
-                with Teacher.TempPdf(self.get_title_page(book.title)) as pdf_path:
-                    with fitz.open(pdf_path) as file:
-                        exam_file.insert_pdf(file)
-                toc.append([2, book.title, page_count])
-                page_count = page_count + 1
-
-                for question_info in section.questions:
-                    filepath = self.librarian.get_document_path(question_info.book)
-                    page_index = question_info.page - 1
-                    with fitz.open(filepath) as file:
+            open_docs: dict[Path, fitz.Document] = {}  # each book is parsed only once
+            try:
+                for section in exam:
+                    book = section.book
+
+                    self.insert_title_page(exam_file, book.title)
+                    toc.append([2, book.title, page_count])
+                    page_count = page_count + 1
+
+                    filepath = self.librarian.get_document_path(book)
+                    if filepath not in open_docs:
+                        open_docs[filepath] = fitz.open(filepath)
+                    page_indices = sorted(info.page - 1 for info in section.questions)
+                    runs = merge_page_runs(page_indices)
+                    for num, (first, last) in enumerate(runs, start=1):
                         exam_file.insert_pdf(
-                            docsrc=file,
-                            from_page=page_index,
-                            to_page=page_index,
+                            docsrc=open_docs[filepath],
+                            from_page=first,
+                            to_page=last,
                             annots=False,
                             widgets=False,
-                            final=True,
+                            # keep the copied fonts and images around for the section's next run
+                            final=num == len(runs),
                         )
-                    toc.append([3, f"Page {page_index + 1}", page_count])
-                    page_count = page_count + 1
+                        for page_index in range(first, last + 1):
+                            toc.append([3, f"Page {page_index + 1}", page_count])
+                            page_count = page_count + 1
+            finally:
+                for file in open_docs.values():
+                    file.close()
 
             # Answer key
             exam_file.new_page()
             exam_file.new_page()
             toc.append([1, "Answer Key", page_count + 2])
-            answer_key = "# Answer Key\n"
+            answer_key = [("Answer Key", ANSWER_KEY_TITLE_SIZE)]
 
             for section in exam:
-                answer_key += f"## {section.book.title}\n"
+                answer_key.append((section.book.title, ANSWER_KEY_HEADING_SIZE))
                 for num, question_info in enumerate(section.questions, start=1):
                     question = question_info.question
-                    answer_key += f"{num}. {question.correct_choice}\n"
-                answer_key += "\n\n"
-
-            # Create temporary file and combine the PDFs
-            md_fd, md_filepath = tempfile.mkstemp(suffix=".md")
-            Path(md_filepath).write_text(answer_key, encoding="utf-8")
-
-            pdf_fd, pdf_filepath = tempfile.mkstemp(suffix=".pdf")
-            pypandoc.convert_file(
-                md_filepath,
-                to="pdf",
-                outputfile=pdf_filepath,
-                extra_args=["--pdf-engine=xelatex"],
-            )
+                    answer_key.append(
+                        (f"{num}. {question.correct_choice}", ANSWER_KEY_TEXT_SIZE)
+                    )
 
-            with fitz.open(pdf_filepath) as obj:
-                exam_file.insert_pdf(obj)
+            self.insert_text_pages(exam_file, answer_key)
 
             # Update the Table of Contents (ToC)
             exam_file.set_toc(toc)
@@ -241,8 +309,7 @@ class Teacher:
             with Pdf.open(filepath) as pdf:
                 pdf.save(output_file, linearize=True)
 
-            for fd in [md_fd, pdf_fd, toc_fd]:
-                os.close(fd)
+            os.close(toc_fd)
 
             # os.replace(filepath, output_file)
         elif filetype == "text":
@@ -255,46 +322,53 @@ class Teacher:
         else:
             raise NotImplementedError(f"unknown filetype {filetype}")
 
-    class TempPdf:
-        def __init__(self, markdown_stuff: str):
-            self.markdown_stuff = markdown_stuff
-
-        def __enter__(self):
-            # Create temporary file and combine the PDFs
-            md_fd, md_filepath = tempfile.mkstemp(suffix=".md")
-            Path(md_filepath).write_text(self.markdown_stuff, encoding="utf-8")
-
-            self.pdf_fd, pdf_filepath = tempfile.mkstemp(suffix=".pdf")
-            pypandoc.convert_file(
-                md_filepath,
-                to="pdf",
-                outputfile=pdf_filepath,
-                extra_args=["--pdf-engine=xelatex"],
-            )
-            os.close(md_fd)
-            return Path(pdf_filepath)
+    def insert_title_page(self, doc: fitz.Document, title: str):
+        """Adds a page with the title centered on it, drawn directly instead of through LaTeX."""
+        width, height = doc[0].rect.width, doc[0].rect.height
+        page = doc.new_page(width=width, height=height)
+        box = fitz.Rect(
+            PAGE_MARGIN, height / 2 - 72, width - PAGE_MARGIN, height / 2 + 72
+        )
+        # Unlike insert_textbox, which draws nothing when the text overflows,
+        # insert_htmlbox scales long titles down until they fit
+        page.insert_htmlbox(
+            box,
+            f"<p>{html.escape(title)}</p>",
+            css=_TITLE_CSS,
+            scale_low=0,
+        )
 
-        def __exit__(self, exc_type, exc, tb):
-            os.close(self.pdf_fd)
+    def insert_text_pages(self, doc: fitz.Document, lines: list[tuple[str, int]]):
+        """
+        Adds pages with one (text, font size) entry per paragraph; larger sizes are drawn in bold.
+        Paragraphs wider than the page are wrapped at word boundaries.
+        """
+        width, height = doc[0].rect.width, doc[0].rect.height
+        max_width = width - 2 * PAGE_MARGIN
+        page = None
+        y = 0
+        for text, fontsize in lines:
+            bold = fontsize > ANSWER_KEY_TEXT_SIZE
+            fontname = "hebo" if bold else "helv"
+            gap = fontsize * (2 if bold else 1.5)
+            for line in wrap_text(text, fontname, fontsize, max_width):
+                y += gap
+                gap = fontsize * 1.2  # wrapped lines sit closer together
+                if page is None or y > height - PAGE_MARGIN:
+                    page = doc.new_page(width=width, height=height)
+                    y = PAGE_MARGIN + fontsize
+                page.insert_text(
+                    (PAGE_MARGIN, y), line, fontsize=fontsize, fontname=fontname
+                )
 
     def get_title_page(self, title: str) -> str:
-        return dedent(
-            rf"""
-            \thispagestyle{{empty}}
-            
-            \vspace*{{\fill}}
-            \begin{{center}}
-            {{\Huge \textbf{{{title}}}}}
-            \end{{center}}
-            \vspace*{{\fill}}
-            """
-        )
+        return _TITLE_PAGE.format(title=title)
 
     def get_new_page(self) -> str:
-        return r"\newpage" + "\n"
+        return _NEW_PAGE
 
     def clean_latex(self, contents: str) -> str:
-        return re.sub(r"[\x00-\x08\x0B\x0C\x0E-\x1F\x7F]", "", contents)
+        return contents.translate(_CONTROL_CHARS)
 
     def get_readable_question(self, question: Question):
         return dedent(
@@ -332,17 +406,86 @@ class Teacher:
                 exam.append(ExamSection(book, questions))
         return exam
 
+    def get_cache_path(self, image_data: str) -> Path:
+        key = sha256(
+            "\0".join([self.model_name, self.system_prompt, image_data]).encode()
+        ).hexdigest()
+        return self.cache_dir / f"{key}.json"
+
+    def ask(self, image_datas: list[str]) -> list[Question | None]:
+        """
+        Asks the model for one question per page in the base64 JPEG images, all in a single request
+        when the model answers every image, otherwise one request per page.
+        Answers are cached on disk, so the same page is only sent once per model and prompt.
+        """
+        cache_paths = [self.get_cache_path(image_data) for image_data in image_datas]
+        questions = []
+        for cache_path in cache_paths:
+            try:
+                questions.append(Question.model_validate_json(cache_path.read_bytes()))
+            except (FileNotFoundError, ValueError):
+                questions.append(None)
+
+        missing = [i for i, question in enumerate(questions) if question is None]
+        if not missing:
+            return questions
+
+        answers = self.request_questions([image_datas[i] for i in missing])
+        if answers is None:
+            # Without one answer per image there is no telling which page each belongs to,
+            # so ask about those pages one at a time instead
+            answers = []
+            for i in missing:
+                answer = self.request_questions([image_datas[i]])
+                answers.append(answer[0] if answer else None)
+
+        for i, question in zip(missing, answers):
+            if question is not None:
+                questions[i] = question
+                cache_paths[i].write_text(question.model_dump_json(), encoding="utf-8")
+        return questions
+
+    def request_questions(self, image_datas: list[str]) -> list[Question] | None:
+        """Sends the images in one request; returns None unless there is one question per image."""
+        completion = self.client.chat.completions.parse(
+            model=self.model_name,
+            messages=[
+                {"role": "system", "content": self.system_prompt},
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "image_url",
+                            "image_url": {"url": f"data:image/jpeg;base64,{image_data}"},
+                        }
+                        for image_data in image_datas
+                    ],
+                },
+            ],
+            response_format=QuestionSet,
+        )
+        question_set = completion.choices[0].message.parsed
+        if question_set is None or len(question_set.questions) != len(image_datas):
+            return None
+        return question_set.questions
+
     def generate_questions(self, book: Book) -> list[QuestionInfo]:
         filepath = self.librarian.get_document_path(book)
         questions = []
-        doc = pymupdf.open(filepath)
-        page_indicies = [random.randint(0, len(doc) - 1) for i in range(5)]
-        for index in page_indicies:
-            pix = doc[index].get_pixmap()
-            bytes = pix.tobytes(output="jpeg")
-            image_data = base64.urlsafe_b64encode(bytes).decode()
-            question = ask_image(self.client, self.model_name, Question, image_data)
-            if question.content and (
+        # Rendering a handful of pages takes milliseconds, far less than starting
+        # worker processes that would re-import the search stack
+        with pymupdf.open(filepath) as doc:
+            page_indicies = [
+                random.randint(0, len(doc) - 1) for i in range(PAGES_PER_BOOK)
+            ]
+            image_datas = []
+            for index in page_indicies:
+                pix = doc[index].get_pixmap()
+                bytes = pix.tobytes(output="jpeg")
+                image_datas.append(base64.b64encode(bytes).decode())
+
+        for index, question in zip(page_indicies, self.ask(image_datas)):
+            if question and question.content and (
                 question.choice_a
                 or question.choice_b
                 or question.choice_c
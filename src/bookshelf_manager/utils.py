@@ -1,12 +1,12 @@
 """Contains utilies necessary for the librarian to function."""
 
-import json
 import os
 import subprocess
 from dataclasses import asdict, dataclass, field
+from functools import lru_cache
 from pathlib import Path
 
-from dacite import from_dict
+import orjson
 from llama_index.core.llms import ChatMessage, ImageBlock, TextBlock
 from llama_index.llms.openai_like import OpenAILike
 
@@ -30,28 +30,43 @@ class Category:
     name: str
     children: list["Category"] = field(default_factory=list)
 
+    @classmethod
+    def from_dict(cls, values: dict) -> "Category":
+        return cls(
+            code=values["code"],
+            name=values["name"],
+            children=[cls.from_dict(child) for child in values.get("children", ())],
+        )
+
 
 class ClassificationSystem:
 
     def __init__(self, type: str):
         self.type = type
+        self.path_cache: dict[str, str] = {}
+
+    def get_path(self, call_number: str) -> str:
+        """Returns the directory path for call_number, resolving each distinct call number only once."""
+        path = self.path_cache.get(call_number)
+        if path is None:
+            path = self.path_cache[call_number] = self.find_path(call_number)
+        return path
 
-    def get_path(
-        self, call_number: str, data_list: list[Category] = None, depth: int = 0
-    ) -> str:
+    def find_path(self, call_number: str) -> str:
         raise NotImplementedError(
             "this is an abstract method, it needs to be implemented in the child class"
         )
 
-    def loads(self, text: str):
-        """Loads from data (string) into type and info."""
-        values = json.loads(text)
+    def loads(self, text: str | bytes):
+        """Loads from JSON data (string or UTF-8 bytes) into type and info."""
+        values = orjson.loads(text)
         type, data = values["type"], values["data"]
         if type != self.type:
             raise ValueError(
                 f"Cannot load from data because {type} is different from {self.type}"
             )
-        self.data_list = [from_dict(Category, info) for info in data]
+        self.data_list = [Category.from_dict(info) for info in data]
+        self.path_cache.clear()
 
     def dumps(self):
         """Dumps the current instance data into a dictionary."""
@@ -63,76 +78,80 @@ class ClassificationSystem:
 
 class DeweyClassificationSystem(ClassificationSystem):
 
-    def __init__(self, text: str):
+    def __init__(self, text: str | bytes):
         super().__init__("dewey")
         self.loads(text)
 
-    def get_path(
-        self, call_number: str, data_list: list[Category] = None, depth: int = 0
-    ) -> str:
-        if data_list is None:
-            data_list = self.data_list
-        for level in data_list:
-            code, name, children = level.code, level.name, level.children
-            if depth >= len(code):
-                break
-
-            dirname = f"{code} {name}"
-            if code == call_number and depth == len(call_number) - 1:
-                return dirname
-            elif code[depth] == call_number[depth] and children:
-                return os.path.join(
-                    dirname,
-                    self.get_path(call_number, children, depth + 1),
-                )
+    def find_path(self, call_number: str) -> str:
+        # Walks down one level per digit instead of recursing
+        dirnames = []
+        data_list = self.data_list
+        depth = 0
+        while data_list is not None:
+            children = None
+            for level in data_list:
+                code, name = level.code, level.name
+                if depth >= len(code):
+                    break
+
+                dirname = f"{code} {name}"
+                if code == call_number and depth == len(call_number) - 1:
+                    dirnames.append(dirname)
+                    return os.path.join(*dirnames)
+                elif code[depth] == call_number[depth] and level.children:
+                    dirnames.append(dirname)
+                    children = level.children
+                    break
+            data_list = children
+            depth += 1
         raise LookupError(f"could not find {call_number}")
 
 
 class LCCClassificationSystem(ClassificationSystem):
 
-    def __init__(self, text: str):
+    def __init__(self, text: str | bytes):
         super().__init__("lcc")
         self.loads(text)
 
-    def get_path(
-        self, call_number: str, data_list: list[Category] = None, depth: int = 0
-    ) -> str:
+    def find_path(self, call_number: str) -> str:
         subject = call_number[:2]
-        if data_list is None:
-            data_list = self.data_list
-        for level in data_list:
-            code, name, children = level.code, level.name, level.children
-            if depth >= 2:
-                break
-
-            dirname = f"{code} {name}"
-            code_depth = code[depth] if len(code) > depth else code[-1]
-            if subject == code and depth == len(subject) - 1:
-                return dirname
-            elif code_depth == subject[depth] and children:
-                return os.path.join(
-                    dirname, self.get_path(call_number, children, depth + 1)
-                )
+        dirnames = []
+        data_list = self.data_list
+        depth = 0
+        while data_list is not None and depth < 2:
+            children = None
+            for level in data_list:
+                code, name = level.code, level.name
+                dirname = f"{code} {name}"
+                code_depth = code[depth] if len(code) > depth else code[-1]
+                if subject == code and depth == len(subject) - 1:
+                    dirnames.append(dirname)
+                    return os.path.join(*dirnames)
+                elif code_depth == subject[depth] and level.children:
+                    dirnames.append(dirname)
+                    children = level.children
+                    break
+            data_list = children
+            depth += 1
         raise LookupError(f"could not find {call_number}")
 
 
 class UDCClassificationSystem(ClassificationSystem):
 
-    def __init__(self, text: str):
+    def __init__(self, text: str | bytes):
         super().__init__("udc")
         self.loads(text)
 
-    def get_path(
-        self, call_number: str, data_list: list[Category] = None, depth: int = 0
-    ) -> str:
+    def find_path(self, call_number: str) -> str:
         raise NotImplementedError("udc not implemented yet")
 
 
-def create_classification_cls(type: str, text: str):
+def create_classification_cls(type: str, text: str | bytes):
     systems = {"dewey": DeweyClassificationSystem, "lcc": LCCClassificationSystem}
     return systems[type](text)
 
 
+@lru_cache
 def get_resource_path(path: Path) -> Path:
     app_dir = Path(os.path.dirname(__file__)).absolute()
     return app_dir / path
@@ -26,6 +26,7 @@ import tempfile
 import threading
 import time
 import unittest
+from dataclasses import asdict
 from pathlib import Path
 from unittest.mock import MagicMock, patch
 
@@ -37,7 +38,8 @@ SRC = ROOT / "src"
 if str(SRC) not in sys.path:
     sys.path.insert(0, str(SRC))
 
-from bookshelf_manager.catalog_manager import Book, CatalogManager, Metadata
+from bookshelf_manager.catalog_manager import BLANK_ISBN, Book, CatalogManager, Metadata
+from bookshelf_manager.cmd_app import CmdApp
 from bookshelf_manager.librarian import Config, DocResult, Librarian
 
 
@@ -158,6 +160,55 @@ class TestCatalogManagerCRUD(unittest.TestCase):
         self.cm.remove(meta.id)
         self.assertNotIn(meta.id, self.cm)
 
+    def test_entries_are_loaded_from_disk(self):
+        meta = make_metadata()
+        self.cm.add(meta, None)
+        reopened = CatalogManager(Path(self.tmp))
+        self.assertEqual(reopened.get(meta.id)[0], meta)
+
+    def test_saved_entry_keeps_json_dumps_format(self):
+        meta = make_metadata()
+        meta.data.title = "Café"
+        self.cm.add(meta, None)
+        contents = (self.cm.catalog_dir / f"{meta.id}.json").read_text(encoding="utf-8")
+        self.assertEqual(contents, json.dumps(asdict(meta), ensure_ascii=False))
+
+    def test_unknown_keys_in_entry_are_ignored(self):
+        meta = make_metadata()
+        values = meta.to_dict()
+        values["added_by_newer_version"] = 1
+        values["data"]["subtitle"] = "Extra"
+        (self.cm.catalog_dir / f"{meta.id}.json").write_text(json.dumps(values))
+        self.cm.reload()
+        self.assertEqual(self.cm.get(meta.id)[0], meta)
+
+    def test_reload_picks_up_external_changes(self):
+        other = CatalogManager(Path(self.tmp))
+        meta = make_metadata()
+        other.add(meta, None)
+        self.assertNotIn(meta.id, self.cm)
+        self.cm.reload()
+        self.assertIn(meta.id, self.cm)
+
+    def test_exists_by_isbn(self):
+        meta = make_metadata()
+        self.cm.add(meta, None)
+        self.assertTrue(self.cm.exists(meta.data.isbn))
+
+    def test_exists_unknown_isbn_returns_false(self):
+        self.assertFalse(self.cm.exists("9781111111111"))
+
+    def test_isbn_index_follows_edit_and_remove(self):
+        meta = make_metadata()
+        self.cm.add(meta, None)
+        edited = make_metadata()
+        edited.data.isbn = "9780306406157"
+        self.cm.edit(edited, b"")
+        self.assertFalse(self.cm.exists("9780000000000"))
+        self.assertTrue(self.cm.exists("9780306406157"))
+        self.cm.remove(meta.id)
+        self.assertFalse(self.cm.exists("9780306406157"))
+
     def test_remove_missing_raises_key_error(self):
         with self.assertRaises(KeyError):
             self.cm.remove("nonexistent-id")
@@ -284,11 +335,20 @@ class TestLibrarianGetPathsIds(LibrarianTestBase):
         lib = self.make_librarian()
         lib.catalog_manager.add(make_metadata(id="keep", filename="keep.pdf"), None)
         lib.catalog_manager.add(make_metadata(id="skip", filename="skip.pdf"), None)
-        lib.config.index_denylist.append("skip")
+        lib.config.index_denylist.add("skip")
         ids = [id_ for _, id_ in lib.get_paths_ids()]
         self.assertIn("keep", ids)
         self.assertNotIn("skip", ids)
 
+    def test_denylist_is_saved_as_sorted_list(self):
+        lib = self.make_librarian()
+        lib.config.index_denylist.update({"b", "a"})
+        lib.config_dirty = True
+        lib.flush()
+        saved = json.loads(lib.config_path.read_text(encoding="utf-8"))
+        self.assertEqual(saved["index_denylist"], ["a", "b"])
+        self.assertEqual(self.make_librarian().config.index_denylist, {"a", "b"})
+
     def test_multiple_entries_all_returned(self):
         lib = self.make_librarian()
         expected = {"a", "b", "c"}
@@ -375,6 +435,127 @@ class TestLibrarianIsDatabaseMismatch(LibrarianTestBase):
             self.assertEqual(lib.is_database_mismatch(), expected)
 
 
+class TestLibrarianFlush(LibrarianTestBase):
+
+    def test_saved_config_keeps_json_dumps_format(self):
+        lib = self.make_librarian()
+        lib.config.index_denylist.update({"b-id", "a-id"})
+        lib.config_dirty = True
+        lib.flush()
+        expected = {**asdict(lib.config), "index_denylist": ["a-id", "b-id"]}
+        self.assertEqual(
+            lib.config_path.read_text(encoding="utf-8"),
+            json.dumps(expected, indent=4, ensure_ascii=False),
+        )
+
+
+class TestLibrarianSync(LibrarianTestBase):
+
+    def test_client_sync_keeps_received_config_and_notes(self):
+        lib = self.make_librarian()
+        lib.count_change()
+        lib.config.index_denylist.add("local-id")
+        lib.config_dirty = True
+
+        def receive(**kwargs):
+            # Stands in for the server's copies arriving over the wire
+            lib.config_path.write_text(json.dumps({"index_denylist": ["remote-id"]}))
+            lib.notes_path.write_text(json.dumps({"changes": 3}))
+
+        with patch("bookshelf_manager.sync.SyncClient") as client_cls:
+            client_cls.return_value.start.side_effect = receive
+            lib.sync(is_client=True, password="pw", server_addr=("127.0.0.1", 1230))
+        lib.close()
+
+        config = json.loads(lib.config_path.read_text())
+        self.assertEqual(config["index_denylist"], ["remote-id"])
+        self.assertEqual(json.loads(lib.notes_path.read_text())["changes"], 3)
+        self.assertEqual(lib.config.index_denylist, {"remote-id"})
+
+
+class TestCmdAppIsValidIsbn(unittest.TestCase):
+    """is_valid_isbn checks the ISBN-10 and ISBN-13 check digits."""
+
+    def is_valid(self, isbn: str) -> bool:
+        return CmdApp.is_valid_isbn(isbn)
+
+    def test_isbn10_with_x_check_digit(self):
+        self.assertTrue(self.is_valid("080442957X"))
+
+    def test_isbn13(self):
+        self.assertTrue(self.is_valid("9780306406157"))
+
+    def test_bad_checksum(self):
+        self.assertFalse(self.is_valid("9780306406158"))
+        self.assertFalse(self.is_valid("0804429579"))
+
+    def test_non_ascii_digits(self):
+        # Arabic-Indic digits pass str.isdigit() but aren't ISBN digits
+        self.assertFalse(self.is_valid("٩٧٨٠٣٠٦٤٠٦١٥٧"))
+        self.assertFalse(self.is_valid("٠٨٠٤٤٢٩٥٧X"))
+
+
+class TestCmdAppIsbnDuplicates(unittest.TestCase):
+    """An ISBN-10 is stored as its ISBN-13, so re-adding it is caught."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cm = CatalogManager(Path(self.tmp))
+        self.app = CmdApp.__new__(CmdApp)
+        self.app.librarian = MagicMock()
+        self.app.librarian.exists.side_effect = self.cm.exists
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_to_isbn13(self):
+        self.assertEqual(CmdApp.to_isbn13("0306406152"), "9780306406157")
+        self.assertEqual(CmdApp.to_isbn13("080442957X"), "9780804429573")
+        self.assertEqual(CmdApp.to_isbn13("9780306406157"), "9780306406157")
+
+    def test_same_isbn10_added_twice_is_rejected(self):
+        pdf = Path(self.tmp) / "book.pdf"
+        pdf.write_bytes(b"%PDF-1.4")
+        details = ["Title", "Author", "", "", "", "", "2024", "", "", ""]
+        with patch("bookshelf_manager.cmd_app.prompt", side_effect=["100", "0-306-40615-2", *details]), \
+                patch("bookshelf_manager.cmd_app.print"):
+            first = self.app.get_metadata_info(filepath=pdf)
+        self.assertEqual(first.data.isbn, "9780306406157")
+        self.cm.add(first, None)
+
+        # The same ISBN-10 is refused, and the blank ISBN is entered instead
+        answers = ["100", "0-306-40615-2", "", *details]
+        with patch("bookshelf_manager.cmd_app.prompt", side_effect=answers), \
+                patch("bookshelf_manager.cmd_app.print"), \
+                patch("bookshelf_manager.cmd_app.error_msg") as mock_error:
+            second = self.app.get_metadata_info(filepath=pdf)
+        mock_error.assert_called_once_with("ISBN 9780306406157 already exists in the database")
+        self.assertEqual(second.data.isbn, BLANK_ISBN)
+
+
+class TestCmdAppConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_unknown_keys_in_config_are_ignored(self):
+        values = {
+            "base_url": "http://localhost:1234/v1",
+            "api_key": "dummy_key",
+            "general_model": "model",
+            "removed_setting": True,
+        }
+        (Path(self.tmp) / "config.json").write_text(json.dumps(values))
+        with patch("bookshelf_manager.cmd_app.user_config_dir", return_value=self.tmp), \
+                patch("bookshelf_manager.cmd_app.OpenAILike"):
+            app = CmdApp()
+        self.assertEqual(app.app_config.general_model, "model")
+        self.assertNotIn("removed_setting", app.saved_app_config)
+
+
 # ===========================================================================
 # 3. mcp.py error-surfacing regression tests (Bug 3)
 # ===========================================================================